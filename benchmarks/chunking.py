@@ -0,0 +1,51 @@
+"""
+measure content-defined chunking: its throughput, the chunk sizes, and how
+many chunks two versions of a blob share after an edit in its middle
+
+    python3 benchmarks/chunking.py [--size MB] [--avg KB]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ugit import chunking  # noqa: E402
+
+
+def _chunks(data, avg_size):
+    start = time.perf_counter()
+    chunks = [bytes(chunk) for chunk in chunking.iter_chunks(data, avg_size)]
+    return chunks, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=256, help='blob size, in MB')
+    parser.add_argument('--avg', type=int, default=1024, help='average chunk size, in KB')
+    args = parser.parse_args()
+
+    size, avg_size = args.size * 1024 * 1024, args.avg * 1024
+    random.seed(0)
+    workloads = (
+        ('random', random.randbytes(size)),
+        # text-like: few distinct byte values
+        ('text', b''.join(b'line %d of some text\n' % random.randrange(10 ** 6)
+                          for _ in range(size // 24))[:size]),
+    )
+    for label, data in workloads:
+        chunks, seconds = _chunks(data, avg_size)
+        middle = len(data) // 2
+        edited = data[:middle] + b'an edit' + data[middle:]
+        edited_chunks, _ = _chunks(edited, avg_size)
+        shared = len(set(chunks) & set(edited_chunks))
+        print(f'{label:<8} {len(data) / 1024 / 1024 / seconds:8.1f} MB/s'
+              f'  {len(chunks)} chunks of {len(data) / len(chunks) / 1024:.0f} KB on average'
+              f'  {shared}/{len(chunks)} shared after an edit')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+measure the throughput of the object formats, to choose one at 'ugit init --object-format'
+
+objects are hashed the way data.hash_object() does (type header, then the
+content), for small objects like trees and commits and for big blobs. The
+best of several runs is used, as it is the least affected by noise.
+
+    python3 benchmarks/hashing.py [--size KB] [--runs N]
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ugit import data  # noqa: E402
+
+
+def _best_seconds(object_format, objects, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        for obj in objects:
+            hasher = data.new_hasher(object_format)
+            hasher.update(b'blob\x00')
+            hasher.update(obj)
+            hasher.hexdigest()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=64 * 1024,
+                        help='total content hashed per run, in KB')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    total = args.size * 1024
+    # (label, size of one object)
+    workloads = (('small objects', 256), ('big blobs', 8 * 1024 * 1024))
+    for label, object_size in workloads:
+        object_size = min(object_size, total)
+        objects = [os.urandom(object_size)] * (total // object_size)
+        mb = object_size * len(objects) / 1024 / 1024
+        print(f'{label} ({object_size} bytes each)')
+        for object_format in data.OBJECT_FORMATS:
+            seconds = _best_seconds(object_format, objects, args.runs)
+            print(f'  {object_format:<10} {mb / seconds:10.1f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
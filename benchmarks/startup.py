@@ -0,0 +1,70 @@
+"""
+measure how long a ugit invocation takes to start up, and enforce a budget
+
+the best of several runs is used, as it is the least affected by noise from
+other processes. The bare interpreter startup ('python -c pass') is measured
+too and subtracted, so the budget only covers what ugit itself adds
+(imports, argument parsing, name resolution).
+
+    python3 benchmarks/startup.py [--runs N] [--budget MS]
+
+exits with status 1 if the overhead of any command is over the budget
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UGIT = [sys.executable, '-c', 'from ugit import cli; cli.main()']
+
+
+def _run(cmd, cwd):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    subprocess.run(cmd, cwd=cwd, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _best_ms(cmd, cwd, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        _run(cmd, cwd)
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=30)
+    parser.add_argument('--budget', type=float, default=40.0,
+                        help='allowed overhead over bare python, in ms')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as repo:
+        _run(UGIT + ['init'], repo)
+        with open(f'{repo}/file', 'w') as f:
+            f.write('content\n')
+        _run(UGIT + ['add', 'file'], repo)
+        _run(UGIT + ['commit', '-m', 'bench'], repo)
+
+        baseline = _best_ms([sys.executable, '-c', 'pass'], repo, args.runs)
+        print(f'{"python -c pass":<24} {baseline:8.2f} ms')
+
+        over_budget = False
+        for command in (['cat-file', 'HEAD'], ['log'], ['branch']):
+            best = _best_ms(UGIT + command, repo, args.runs)
+            overhead = best - baseline
+            over_budget |= overhead > args.budget
+            print(f'{"ugit " + " ".join(command):<24} {best:8.2f} ms'
+                  f'  (+{overhead:.2f} ms)')
+
+    if over_budget:
+        print(f'startup overhead is over the budget of {args.budget} ms')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,21 +6,25 @@ import itertools
 import operator
 import os
 import string
+import time
 
 from collections import deque, namedtuple
 
 from . import data
-from . import diff
+from . import ignore
 
-def init():
+def init(object_store='loose', object_format='sha1'):
     """
     make HEAD point to a ref refs/heads/master 
     so that the repository has an initial branch, 
     called master (meaning the main branch). 
     The branch could have been named anything we'd like but master is the standard name
     used for the first branch in Git.
+
+    :object_store: 'loose' or 'sqlite', see object_store.py
+    :object_format: the hash of oids, 'sha1', 'sha256' or 'blake2b'
     """
-    data.init()
+    data.init(object_store, object_format)
     # HEAD is a symbolic ref that points to master
     data.update_ref('HEAD', data.RefValue(symbolic=True, value='refs/heads/master'))
 
@@ -44,7 +48,7 @@ def write_tree():
     """
     # Index is flat list, we need it as a tree of dicts
     index_as_tree = {}
-    with data.get_index() as index:
+    with data.get_index(write=False) as index:
         for path, oid in index.items():
             path = path.split('/')
             dirpath, filename = path[:-1], path[-1]
@@ -60,7 +64,7 @@ def write_tree():
         work with the tree of dicts and write them to the objects store
         """
         entries = []
-        for name, value in tree_dict().items():
+        for name, value in tree_dict.items():
             if type(value) is dict:
                 # get an oid of the tree that can represent the directory
                 type_ = 'tree'
@@ -68,7 +72,7 @@ def write_tree():
             else:
                 type_ = 'blob'
                 oid = value
-                entries.append ((name, oid, type_))
+            entries.append ((name, oid, type_))
         
         # create a tree for this level of the directory
         tree = ''.join(f'{type_} {oid} {name}\n'
@@ -77,7 +81,8 @@ def write_tree():
         # return the oid of the tree (the content in files in /objects show a extra tree)
         return data.hash_object(tree.encode(), 'tree')
     
-    return write_tree_recursive(index_as_tree)
+    with data.batch_objects():
+        return write_tree_recursive(index_as_tree)
 
 def _iter_tree_entries(oid):
     """
@@ -99,6 +104,16 @@ def get_tree(oid, base_path=""):
     
     :return: a dictionary {path: oid} contains every node in the tree
     """
+    # trees are immutable, so a parsed tree can be reused as long as the
+    # caller can't modify the cached copy
+    cache = data.get_cache('trees')
+    if cache is not None and not base_path and oid:
+        if oid not in cache:
+            data.cache_add(cache, oid, _get_tree(oid), data.CACHE_MAX_TREES)
+        return dict(cache[oid])
+    return _get_tree(oid, base_path)
+
+def _get_tree(oid, base_path=''):
     result = {}
     for type_, oid, name in _iter_tree_entries(oid):
         assert '/' not in name
@@ -110,11 +125,49 @@ def get_tree(oid, base_path=""):
             result[path] = oid
         elif type_ == 'tree':
             # 'update()' inserts the specified items to the dictionary.
-            result.update(get_tree(oid, f'{path}/'))
+            result.update(_get_tree(oid, f'{path}/'))
         else:
             assert False, f'Unknow tree entry {type_}'
     return result
 
+def get_tree_entry(tree_oid, path):
+    """
+    look up a single path in a tree, reading only the trees on the way
+    
+    :return: the oid of the blob or tree at 'path', or None if it doesn't exist
+    """
+    oid = tree_oid
+    for name in path.split('/'):
+        if not oid:
+            return None
+        oid = next((entry_oid for _, entry_oid, entry_name in _iter_tree_entries(oid)
+                    if entry_name == name), None)
+    return oid
+
+def iter_changed_paths(t_from, t_to, base_path=''):
+    """
+    compare two tree oids, descending only into subtrees that differ
+    
+    :return: a generator of the paths of the blobs that differ
+    """
+    if t_from == t_to:
+        return
+    entries_from = {name: (type_, oid) for type_, oid, name in _iter_tree_entries(t_from)}
+    entries_to = {name: (type_, oid) for type_, oid, name in _iter_tree_entries(t_to)}
+    for name in entries_from.keys() | entries_to.keys():
+        e_from = entries_from.get(name, (None, None))
+        e_to = entries_to.get(name, (None, None))
+        if e_from == e_to:
+            continue
+        path = base_path + name
+        # a side that isn't a tree contributes nothing to the recursion
+        subtree_from = e_from[1] if e_from[0] == 'tree' else None
+        subtree_to = e_to[1] if e_to[0] == 'tree' else None
+        if 'blob' in (e_from[0], e_to[0]):
+            yield path
+        if subtree_from or subtree_to:
+            yield from iter_changed_paths(subtree_from, subtree_to, f'{path}/')
+
 def get_working_tree():
     """
     walk over all files in the working directory, 
@@ -122,49 +175,81 @@ def get_working_tree():
     :return: a dict {file path : hash(object in the file)}
     This dictionary will represent a "tree" without actually writing a tree object.
     """
+    # with 'ugit fsmonitor' running, only the paths that changed since the
+    # last call need to be looked at
+    if os.path.isfile(f'{data.GIT_DIR}/fsmonitor/pid'):
+        from . import fsmonitor
+        result = fsmonitor.get_working_tree()
+        if result is not None:
+            return result
+    return scan_working_tree()
+
+def scan_working_tree(top='.'):
+    """
+    walk over all files under 'top' and hash them
+    
+    :return: a dict {file path : oid}
+    """
     result = {}
-    for root, _, filenames in os.walk('.'):
+    # remember the oid of every file by its stat, so that unchanged files
+    # aren't hashed again (only when caches are enabled)
+    cache = data.get_cache('working tree')
+    sparse_dirs = data.get_sparse_dirs()
+    with data.batch_objects():
+        _scan_into(result, top, cache, sparse_dirs)
+    return result
+
+def _scan_into(result, top, cache, sparse_dirs):
+    # ignored directories (build output...) aren't even walked into
+    for root, dirnames, filenames in ignore.walk(top):
+        if sparse_dirs is not None:
+            # don't descend into directories outside of the sparse checkout
+            dirnames[:] = [d for d in dirnames 
+                           if _is_sparse_dir_needed(os.path.relpath(f'{root}/{d}'), sparse_dirs)]
         for filename in filenames:
             path = os.path.relpath(f'{root}/{filename}')
-            if is_ignored(path) or not os.path.isfile(path):
+            if not os.path.isfile(path):
                 continue
-            with open(path, 'rb') as f:
-                result[path] = data.hash_object(f.read())
-    return result
+            if not is_sparse_included(path, sparse_dirs):
+                continue
+            result[path] = data.cached_by_stat(cache, path,
+                                               lambda: _hash_file(path))
+
+def _hash_file(path):
+    with open(path, 'rb') as f:
+        return data.hash_object(f.read())
 
 def _empty_current_directory():
     """
     delete all existing stuff before reading
     """
-    # os.walk()
-    # Generate the file names in a directory tree 
-    # by walking the tree either top-down or bottom-up. 
+    # ignore.walk() is os.walk() without the ignored files and directories
     # :root: is a string, the path to the directory
     # :dirnames:  is a list of the names of the subdirectories in dirpath 
     #            (including symlinks to directories, and excluding '.' and '..')
     # :filenames: is a list of the names of the non-directory files in root
-    for root, dirnames, filenames in os.walk('.', topdown=False):
+    dirs = []
+    for root, dirnames, filenames in ignore.walk('.'):
         # iterate every files
         for filename in filenames:
             # Return a relative filepath to path 
             path = os.path.relpath(f'{root}/{filename}')
-            if is_ignored(path) or not os.path.isfile(path):
+            if not os.path.isfile(path):
                 continue
             os.remove(path)
-        # iterate every directory
-        for dirname in dirnames:
-            path = os.path.relpath(f'{root}/{dirname}')
-            if is_ignored(path):
-                continue
-            try:
-                # delete a empty directory
-                os.rmdir(path)
-            except(FileNotFoundError, OSError):
-                # Deletion might fail if the directory contains ignored files,
-                # so it's OK
-                pass
-
-def read_tree(tree_oid, upload_working=False):
+        dirs.extend(os.path.relpath(f'{root}/{dirname}') for dirname in dirnames)
+    # the walk is top-down (to prune ignored directories), so remove the
+    # directories in reverse: subdirectories before their parents
+    for path in reversed(dirs):
+        try:
+            # delete a empty directory
+            os.rmdir(path)
+        except(FileNotFoundError, OSError):
+            # Deletion might fail if the directory contains ignored files,
+            # so it's OK
+            pass
+
+def read_tree(tree_oid, update_working=False):
     """
     uses 'get_tree' to get {path : oid}
     update index with 'get_tree' result
@@ -174,39 +259,142 @@ def read_tree(tree_oid, upload_working=False):
         index.clear()
         index.update(get_tree(tree_oid))
 
-        if upload_working:
+        if update_working:
             _checkout_index(index)
 
 def read_tree_merged(t_base, t_HEAD, t_other, update_working=False):
     """
-    calls diff.merge_trees()
+    calls merge_trees()
     writes the resulting merged tree to the working directory
     """
     with data.get_index() as index:
         index.clear()
-        index.update(diff.merge_trees(
-            get_tree(t_base),
-            get_tree(t_HEAD),
-            get_tree(t_other)
-        ))
+        index.update(merge_trees(t_base, t_HEAD, t_other))
 
         if update_working:
             _checkout_index(index)    
 
+def merge_trees(t_base, t_HEAD, t_other):
+    """
+    three-way merge of tree objects: a file or a whole directory that only one side
+    changed (or both changed the same way) is taken as it is, without being read;
+    only the files changed on both sides are merged with diff.merge_blobs()
+    
+    :return: the merged tree as a dictionary {path: oid}
+    """
+    result = {}
+    _merge_entries(('tree', t_base) if t_base else None,
+                   ('tree', t_HEAD) if t_HEAD else None,
+                   ('tree', t_other) if t_other else None, '', result)
+    return result
+
+def _merge_entries(e_base, e_HEAD, e_other, path, result):
+    """
+    merge the entries (type, oid) or None of 'path' in the three trees into result
+    """
+    if e_HEAD == e_other or e_base == e_other:
+        _add_entry(e_HEAD, path, result)
+        return
+    if e_base == e_HEAD:
+        _add_entry(e_other, path, result)
+        return
+
+    # changed on both sides
+    from . import diff
+    entries = (e_base, e_HEAD, e_other)
+    types = {entry[0] for entry in entries if entry}
+    if types == {'tree'}:
+        subtrees = [{name: (type_, oid) for type_, oid, name in _iter_tree_entries(entry and entry[1])}
+                    for entry in entries]
+        prefix = f'{path}/' if path else ''
+        for name in sorted(set().union(*subtrees)):
+            _merge_entries(*(subtree.get(name) for subtree in subtrees), prefix + name, result)
+    elif types == {'blob'}:
+        result[path] = data.hash_object(diff.merge_blobs(*(entry and entry[1] for entry in entries)))
+    else:
+        # a file on one side and a directory on the other: merge them file by file
+        result.update(diff.merge_tree(*(_flatten_entry(entry, path) for entry in entries)))
+
+def _add_entry(entry, path, result):
+    if entry:
+        result.update(_flatten_entry(entry, path))
+
+def _flatten_entry(entry, path):
+    """
+    :return: {path: oid} of the files of a tree entry (type, oid) or None
+    """
+    if not entry:
+        return {}
+    if entry[0] == 'blob':
+        return {path: entry[1]}
+    if not path:
+        return get_tree(entry[1])
+    return get_tree(entry[1], f'{path}/')
+
 def get_index_tree():
     """
     return index tree
     """
-    with data.get_index() as index:
+    with data.get_index(write=False) as index:
         return index
 
 def _checkout_index(index):
+    # in a sparse checkout, only the paths in the sparse directories are written
+    index = filter_sparse(index)
+    # in a partial clone, get the missing blobs in one go
+    data.fetch_missing_objects(index.values())
     _empty_current_directory()
     for path, oid in index.items():
         os.makedirs(os.path.dirname(f'./{path}'), exist_ok=True)
         with open(path, 'wb') as f:
-            f.write(data.get_object(oid, 'blob'))
+            data.write_object(oid, f)
+
+
+def is_sparse_included(path, sparse_dirs):
+    """
+    if the file 'path' is checked out in a sparse checkout of 'sparse_dirs'
+    
+    like git's cone mode: files at the top level, and everything under 
+    the sparse directories. Only the parent directories of a path are looked 
+    up, so it doesn't get slower with the number of sparse directories.
+    """
+    if sparse_dirs is None:
+        return True
+    parts = path.split('/')
+    if len(parts) == 1:
+        return True
+    return any('/'.join(parts[:i]) in sparse_dirs for i in range(1, len(parts)))
 
+def _is_sparse_dir_needed(dirname, sparse_dirs):
+    """
+    if a directory is in the sparse checkout or leads to one
+    """
+    if is_sparse_included(f'{dirname}/x', sparse_dirs):
+        return True
+    prefix = f'{dirname}/'
+    return any(d.startswith(prefix) for d in sparse_dirs)
+
+def filter_sparse(tree):
+    """
+    :return: the entries of tree {path: oid} that are in the sparse checkout,
+             entries outside of it aren't on disk but aren't deleted either
+    """
+    sparse_dirs = data.get_sparse_dirs()
+    if sparse_dirs is None:
+        return tree
+    return {path: oid for path, oid in tree.items()
+            if is_sparse_included(path, sparse_dirs)}
+
+def set_sparse_checkout(dirs):
+    """
+    change the sparse directories (None for the whole tree)
+    and update the working directory to match
+    """
+    if dirs is not None:
+        dirs = {os.path.normpath(d).strip('/') for d in dirs}
+    data.set_sparse_dirs(dirs)
+    with data.get_index(write=False) as index:
+        _checkout_index(index)
 
 def commit(message):
     """
@@ -218,6 +406,7 @@ def commit(message):
     :return: the oid of commit (current commit and parent commit)
     """
     commit = f'tree {write_tree()}\n'
+    commit += f'time {_timestamp()}\n'
     
     # get oid from the HEAD file
     HEAD = data.get_ref('HEAD').value
@@ -235,10 +424,21 @@ def commit(message):
     
     oid = data.hash_object(commit.encode(), 'commit')
     
-    data.update_ref('HEAD', data.RefValue(symbolic=False, value=oid))
+    # fails instead of losing a commit made by another process meanwhile
+    data.update_ref('HEAD', data.RefValue(symbolic=False, value=oid),
+                    old=data.RefValue(symbolic=False, value=HEAD))
     
     return oid
 
+def _timestamp():
+    """
+    :return: the current time as 'seconds-since-epoch +hhmm' (the local UTC offset)
+    """
+    now = time.time()
+    offset = time.localtime(now).tm_gmtoff // 60
+    sign = '-' if offset < 0 else '+'
+    return f'{int(now)} {sign}{abs(offset) // 60:02}{abs(offset) % 60:02}'
+
 def checkout(name):
     """
     populate the working directory 
@@ -369,7 +569,9 @@ def get_branch_name():
     assert HEAD.startswith('refs/heads/')
     return os.path.relpath(HEAD, 'refs/heads')
 
-Commit = namedtuple('Commit', ['tree', 'parents', 'message'])
+# time is (seconds since epoch, '+hhmm' offset), None for commits written before
+# ugit recorded it
+Commit = namedtuple('Commit', ['tree', 'parents', 'message', 'time'], defaults=[None])
 
 def get_commit(oid):
     """
@@ -377,9 +579,18 @@ def get_commit(oid):
     
     :return: 'Commit' tuple: tree, parent, message
     """
+    cache = data.get_cache('commits')
+    if cache is not None:
+        if oid not in cache:
+            data.cache_add(cache, oid, _get_commit(oid))
+        return cache[oid]
+    return _get_commit(oid)
+
+def _get_commit(oid):
     #  merges two commits together, 
     # therefore the commit has two parent commits.
     parents = []
+    timestamp = None
     
     commit = data.get_object(oid, 'commit').decode()
     lines = iter(commit.splitlines())
@@ -390,17 +601,24 @@ def get_commit(oid):
             tree = value
         elif key == 'parent': # parent
             parents.append(value)
+        elif key == 'time':
+            seconds, offset = value.split(' ')
+            timestamp = (int(seconds), offset)
         else:
             assert False, f'Unknown field {key}'
     
     # the commit object - two / one lines oid infromation = message
     message = '\n'.join(lines)
-    return Commit(tree=tree, parents=parents, message=message)
+    return Commit(tree=tree, parents=parents, message=message, time=timestamp)
 
-def iter_commits_and_parents(oids):
+def iter_commits_and_parents(oids, first_parent=False, since=None):
     """
     get a list of all commits 
     and then recursively iterates on the trees in each commit
+
+    :first_parent: only follow the first parent of merge commits
+    :since: don't walk past commits older than this (seconds since epoch): their
+            parents are older still, as a commit is made after its parents
     """
     # Must yield the oid before acccessing it (to allow caller to fetch it
     # if needed)
@@ -409,6 +627,8 @@ def iter_commits_and_parents(oids):
     # so that the order of commits is deterministic.
     oids = deque(oids)
     visited = set()
+    # the parents of shallow commits weren't fetched, they are roots here
+    shallow = data.get_shallow()
     
     while oids:
         oid = oids.popleft()
@@ -416,17 +636,55 @@ def iter_commits_and_parents(oids):
             continue
         visited.add(oid)
         yield oid
+        if oid in shallow:
+            continue
     
         commit = get_commit(oid)
+        if since is not None and commit.time and commit.time[0] < since:
+            continue
         # Return first parent next
-        oids.appendleft(commit.parent[:1])
+        oids.extendleft(commit.parents[:1])
         # Return other parent next
-        oid.appendleft(commit.parents[1:])
+        if not first_parent:
+            oids.extend(commit.parents[1:])
+
+def iter_commits_to_depth(oids, depth=None, boundary=None):
+    """
+    walk the history breadth first, at most 'depth' commits deep 
+    (the commits in oids are at depth 1), regardless of the shallow commits
+    
+    :boundary: a set which gets the walked commits whose parents weren't walked
+    """
+    # Must yield the oid before acccessing it (to allow caller to fetch it
+    # if needed)
+    level = list(oids)
+    visited = set()
+    current_depth = 1
+    while level:
+        next_level = []
+        for oid in level:
+            if not oid or oid in visited:
+                continue
+            visited.add(oid)
+            yield oid
+            
+            commit = get_commit(oid)
+            if depth is not None and current_depth >= depth:
+                if commit.parents and boundary is not None:
+                    boundary.add(oid)
+            else:
+                next_level.extend(commit.parents)
+        level = next_level
+        current_depth += 1
 
-def iter_objects_in_commits (oids):
+def iter_objects_in_commits (oids, blobs=True, depth=None, boundary=None):
     """
     take a list of commit OIDs 
     and return all objects that are reachable from these commits
+    
+    :blobs: if False, only commits and trees (for partial clones)
+    :depth: and :boundary: as in iter_commits_to_depth(), the walk ignores
+            shallow commits if either is given
     """
     # Must yield the oid before acccessing it 
     # (to allow caller to fetch it if needed)
@@ -439,11 +697,15 @@ def iter_objects_in_commits (oids):
             if oid not in visited:
                 if type_ == 'tree':
                     yield from iter_objects_in_tree(oid)
-                else:
+                elif blobs:
                     visited.add(oid)
                     yield oid
 
-    for oid in iter_commits_and_parents(oids):
+    if depth is None and boundary is None:
+        commits = iter_commits_and_parents(oids)
+    else:
+        commits = iter_commits_to_depth(oids, depth, boundary)
+    for oid in commits:
         yield oid
         commit = get_commit(oid)
         if commit.tree not in visited:
@@ -469,10 +731,10 @@ def get_oid(name):
         if data.get_ref(ref, deref=False).value:
             return data.get_ref(ref).value
     
-    # Name is SHA1 (oid)
+    # Name is an oid (40 characters for sha1, 64 for sha256 or blake2b)
     # hexdigits: "0123456789abcdefABCDEF"
     is_hex = all(c in string.hexdigits for c in name)
-    if len(name) == 40 and is_hex:
+    if len(name) == data.oid_length() and is_hex:
         return name
     
     assert False, f'Unknown name {name}'
@@ -495,14 +757,25 @@ def add(filenames):
         """
         handle directory path
         """
-        for root, _, filenames in os.walk(dirname):
+        if os.path.isfile(f'{data.GIT_DIR}/fsmonitor/pid'):
+            from . import fsmonitor
+            if fsmonitor.is_running():
+                # the working tree is already up to date, no need to walk or hash
+                prefix = '' if os.path.relpath(dirname) == '.' else f'{os.path.relpath(dirname)}/'
+                index.update((path, oid) for path, oid in get_working_tree().items()
+                             if path.startswith(prefix))
+                return
+        sparse_dirs = data.get_sparse_dirs()
+        for root, _, filenames in ignore.walk(dirname):
             for filename in filenames:
                 path = os.path.relpath(f'{root}/{filename}')
-                if is_ignored(path) or not os.path.isfile(path):
+                if not os.path.isfile(path):
+                    continue
+                if not is_sparse_included(path, sparse_dirs):
                     continue
                 add_file(path)
     
-    with data.get_index() as index:
+    with data.get_index() as index, data.batch_objects():
         for name in filenames:
             if os.path.isfile(name):
                 add_file(name)
@@ -510,8 +783,9 @@ def add(filenames):
                 add_directory(name)
         
 
-def is_ignored(path):
+def is_ignored(path, is_dir=False):
     """
-    ignore it the directory that isn't part of the user's files?
+    ignore it the path that isn't part of the user's files?
+    (.ugit, and what .ugitignore matches, see ignore.py)
     """
-    return '.ugit' in path.split('/')
\ No newline at end of file
+    return ignore.get_matcher().is_ignored(path, is_dir)
\ No newline at end of file
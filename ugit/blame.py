@@ -0,0 +1,127 @@
+"""
+contain blame: finding the commit that introduced each line of a file
+
+The history is walked backwards from a commit. Each commit passes the lines
+it kept unchanged (according to diff.map_lines) on to its parents, and is
+blamed for the rest. The walk stops as soon as every line is attributed.
+
+The result for (path, commit) is stored in .ugit/blame/, so blaming again
+after new commits only walks the new part of the history: reaching a
+commit that was blamed before attributes all its pending lines at once.
+"""
+import hashlib
+import json
+import os
+
+from collections import deque
+
+from . import base
+from . import data
+from . import diff
+
+
+def _cache_path(path, oid):
+    key = hashlib.sha1(path.encode()).hexdigest()
+    return f'{data.GIT_DIR}/blame/{key}/{oid}'
+
+def _load_cached(path, oid):
+    try:
+        with open(_cache_path(path, oid)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # not cached, or unreadable: computed again (and cached) by the caller
+        return None
+
+def _save_cached(path, oid, attribution):
+    cache_path = _cache_path(path, oid)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # readers never see a half-written entry, even if blame is killed
+    # or runs twice at the same time
+    tmp = f'{cache_path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(attribution, f)
+    os.replace(tmp, cache_path)
+
+def blame(path, oid):
+    """
+    :return: a list with (commit oid, line number in that commit) for each
+             line of 'path' at the commit 'oid', line numbers start at 1
+    """
+    path = os.path.normpath(path)
+    cached = _load_cached(path, oid)
+    if cached is not None:
+        return [tuple(entry) for entry in cached]
+
+    blob_lines = {}
+    def get_lines(blob):
+        if blob not in blob_lines:
+            blob_lines[blob] = data.get_object(blob).splitlines(keepends=True)
+        return blob_lines[blob]
+
+    def get_blob(commit_oid):
+        return base.get_tree_entry(base.get_commit(commit_oid).tree, path)
+
+    blob = get_blob(oid)
+    assert blob, f'{path} does not exist in {oid}'
+    result = [None] * len(get_lines(blob))
+
+    shallow = data.get_shallow()
+    complete = True
+    # commit -> [(index in the result, index in the commit's version of the file)]
+    pending = {oid: [(i, i) for i in range(len(result))]}
+    queue = deque([oid])
+    while queue:
+        commit_oid = queue.popleft()
+        lines = pending.pop(commit_oid)
+
+        previous = _load_cached(path, commit_oid)
+        if previous is not None:
+            for i_result, i_here in lines:
+                result[i_result] = tuple(previous[i_here])
+            continue
+
+        blob = get_blob(commit_oid)
+        # the parents of shallow commits weren't fetched: the boundary
+        # commit gets the lines it has
+        parents = base.get_commit(commit_oid).parents
+        if commit_oid in shallow:
+            parents = []
+            # a deeper fetch would change the result, don't cache it
+            complete = False
+        for parent in parents:
+            if not lines:
+                break
+            parent_blob = get_blob(parent)
+            if not parent_blob:
+                continue
+            if parent_blob == blob:
+                # unchanged, the parent gets all the lines as they are
+                kept = {i: i for _, i in lines}
+            else:
+                kept = diff.map_lines(get_lines(parent_blob), get_lines(blob))
+            passed = [(i_result, kept[i_here]) for i_result, i_here in lines
+                      if i_here in kept]
+            if passed:
+                lines = [(i_result, i_here) for i_result, i_here in lines
+                         if i_here not in kept]
+                if parent not in pending:
+                    pending[parent] = []
+                    queue.append(parent)
+                pending[parent].extend(passed)
+
+        # whatever no parent has is new in this commit
+        for i_result, i_here in lines:
+            result[i_result] = (commit_oid, i_here + 1)
+
+    if complete:
+        _save_cached(path, oid, result)
+    return result
+
+def iter_blame_lines(path, oid):
+    """
+    :return: a generator of (commit oid, commit, line number, line) for each line
+    """
+    lines = data.get_object(base.get_tree_entry(base.get_commit(oid).tree,
+                                                os.path.normpath(path))).splitlines()
+    for (commit_oid, line_no), line in zip(blame(path, oid), lines):
+        yield commit_oid, base.get_commit(commit_oid), line_no, line
@@ -0,0 +1,82 @@
+"""
+contain content-defined chunking, used to store large blobs as chunks
+
+Chunk boundaries are found with a rolling hash, like the gear hash of
+FastCDC: every position gets a hash of the WINDOW bytes up to it, and a cut
+is made where hashes are rare values, so boundaries depend on the content
+around them, not on offsets. An edit only changes the chunks around it,
+the other chunks are the same objects as before.
+
+A hash updated in a Python loop for every byte would chunk a few MB per
+second, so the hashes of a whole range are computed at once, in C: the
+bytes are read as one big integer and multiplied by a WINDOW bytes long
+key. Byte i of the product is the sum of the key bytes times the bytes
+i - WINDOW + 1 to i (plus carries from the bytes before). The rare values
+are then found with bytes.translate() and bytes.find().
+"""
+import hashlib
+
+# bytes hashed into each position
+WINDOW = 32
+
+# Derived from fixed seeds: they must never change or blobs would be
+# chunked differently.
+# a permutation of the byte values, so that close values (like ASCII
+# letters) don't give close products
+_SPREAD = bytes(sorted(range(256), key=lambda i: hashlib.sha256(b'ugit chunk spread %d' % i).digest()))
+_KEY = int.from_bytes(hashlib.sha256(b'ugit chunk key').digest(), 'little') | 1
+
+
+def _rare(avg_size):
+    """
+    :return: (a translate() table giving 0 to rare bytes, run length) such that
+             a run of that many rare hash bytes is found once every ~avg_size bytes
+    """
+    bits = max(1, avg_size.bit_length() - 1)
+    run_length = -(-bits // 7)
+    threshold = max(1, round(256 * 2 ** (-bits / run_length)))
+    return bytes(0 if i < threshold else 1 for i in range(256)), run_length
+
+def _find_run(view, lead, begin, end, table, run):
+    """
+    :return: the offset in view of the first run of rare hashes starting in
+             [begin, end), or -1. The hashes are computed from 'lead' on
+    """
+    stop = min(end + len(run) - 1, len(view))
+    x = int.from_bytes(bytes(view[lead:stop]).translate(_SPREAD), 'little')
+    hashes = (x * _KEY).to_bytes(stop - lead + WINDOW + 1, 'little')
+    found = hashes.translate(table).find(run, begin - lead, stop - lead)
+    return -1 if found < 0 else lead + found
+
+def iter_chunks(data, avg_size):
+    """
+    split data at content-defined boundaries
+
+    chunks are between avg_size / 4 and avg_size * 4 bytes long
+    (except the last one)
+
+    :return: a generator of memoryviews over data
+    """
+    view = memoryview(data)
+    min_size, max_size = avg_size // 4, avg_size * 4
+    table, run_length = _rare(avg_size)
+    run = b'\x00' * run_length
+    size = len(data)
+    start = 0
+    while start < size:
+        end = min(start + max_size, size)
+        cut = end
+        # the run ends at the cut, no cut can be closer than min_size. The
+        # hashes are computed one range at a time, placed from the start of
+        # the chunk, so that the cut only depends on the content after it
+        begin = start + min_size - run_length
+        while begin <= end - run_length:
+            range_end = min(begin + avg_size, end - run_length + 1)
+            found = _find_run(view, max(start, begin - WINDOW), max(start, begin),
+                              range_end, table, run)
+            if found >= 0:
+                cut = found + run_length
+                break
+            begin = range_end
+        yield view[start:cut]
+        start = cut
@@ -6,23 +6,58 @@ In charge of parsing and processing user input.
 import argparse
 import os 
 import sys
-import textwrap
-import subprocess
 
 from . import data
-from . import base
-from . import diff
-from . import remote
+# base, diff and remote (and the heavier stdlib modules they pull in) are
+# imported inside the commands that need them, so that e.g. 'cat-file'
+# doesn't pay for loading the merge or remote machinery on every call
 
 
 def main():
     # parse the args and call whatever function was selected
     # initialized the GIT_GIR
+    if os.environ.get('UGIT_LOCK_STATS'):
+        import atexit
+        atexit.register(lambda: print(data.format_lock_stats(), file=sys.stderr))
     with data.change_git_dir('.'):
-        args = parse_args()
+        argv = sys.argv[1:]
+        # read-only commands are answered by 'ugit daemon' if one is running
+        if os.path.exists(f'{data.GIT_DIR}/daemon.sock'):
+            from . import daemon
+            status = daemon.forward(argv)
+            if status is not None:
+                sys.exit(status)
+        args = parse_args(argv)
         args.func(args)
-    
-def parse_args():
+
+
+class _UnusedParser:
+    """
+    stand-in for the subparsers of commands that weren't requested,
+    so that their arguments aren't built on every invocation
+    """
+    def add_argument(self, *args, **kwargs):
+        pass
+
+
+def _peek_command(argv):
+    """
+    :return: the command name in argv, or None if argv starts with an option (like -h)
+    """
+    if argv and not argv[0].startswith('-'):
+        return argv[0]
+    return None
+
+def parse_args(argv=None, build_all=False):
+    if argv is None:
+        argv = sys.argv[1:]
+    # for log, everything after '--' is a path ('log [<commit>] -- <path>...'),
+    # taken out here as argparse would give the first path to <commit>;
+    # other commands leave '--' to argparse (e.g. 'add -- <file>', 'commit -m --')
+    paths = []
+    if _peek_command(argv) == 'log' and '--' in argv:
+        split = argv.index('--')
+        argv, paths = argv[:split], argv[split + 1:]
     parser = argparse.ArgumentParser()
     
     # when a program performs several different functions 
@@ -31,106 +66,195 @@ def parse_args():
     commands = parser.add_subparsers(dest="command")
     commands.required = True
     
-    # resolve name to oid in argparse
-    oid = base.get_oid
+    # only the subparser of the requested command is built,
+    # the others are needed just for help messages and typos
+    wanted = None if build_all else _peek_command(argv)
+    built = []
+    
+    def add_command(name, func):
+        if wanted and name != wanted:
+            return _UnusedParser()
+        command_parser = commands.add_parser(name)
+        command_parser.set_defaults(func=func)
+        built.append(name)
+        return command_parser
+    
+    # names (refs, tags, branches, oids) are resolved to oids by the commands
+    # themselves with _oid(), not by argparse, so that a command that fails
+    # validation never touches the ref files
     
     # create parser for 'init' command, and bind 'init' with init()
-    init_parser = commands.add_parser('init')
-    init_parser.set_defaults(func=init)
+    init_parser = add_command('init', init)
+    init_parser.add_argument('--object-store', choices=['loose', 'sqlite'], default='loose')
+    init_parser.add_argument('--object-format', choices=list(data.OBJECT_FORMATS), default='sha1')
     
     # create parser for 'hash-object' command, and bind 'hash-object' with hash_object()
-    hash_object_parser = commands.add_parser('hash-object')
-    hash_object_parser.set_defaults(func=hash_object)
+    hash_object_parser = add_command('hash-object', hash_object)
     hash_object_parser.add_argument('file')
     
     # create parser for 'cat-file' command, and bind
-    cat_file_parser = commands.add_parser('cat-file')
-    cat_file_parser.set_defaults(func=cat_file)
-    cat_file_parser.add_argument('object', type=oid)
+    cat_file_parser = add_command('cat-file', cat_file)
+    cat_file_parser.add_argument('object', nargs='?')
+    # read names from stdin, print '<oid> <type> <size>' (and the content with --batch)
+    cat_file_parser.add_argument('--batch', action='store_true')
+    cat_file_parser.add_argument('--batch-check', action='store_true')
+    # don't flush after each object, for non-interactive readers
+    cat_file_parser.add_argument('--buffer', action='store_true')
     
     # create parser for 'write-tree' command, and bind
-    write_tree_parser = commands.add_parser('write-tree')
-    write_tree_parser.set_defaults(func=write_tree)
+    add_command('write-tree', write_tree)
     
     # create parser for 'read-tree' command, and bind
-    read_tree_parser = commands.add_parser ('read-tree')
-    read_tree_parser.set_defaults (func=read_tree)
-    read_tree_parser.add_argument ('tree', type=oid)
+    read_tree_parser = add_command('read-tree', read_tree)
+    read_tree_parser.add_argument ('tree')
     
     # create parser for 'commit' command, and bind
-    commit_parser = commands.add_parser ('commit')
-    commit_parser.set_defaults (func=commit)
+    commit_parser = add_command('commit', commit)
     commit_parser.add_argument ('-m', '--message', required=True)
     
-    log_parser = commands.add_parser ('log')
-    log_parser.set_defaults (func=log)
+    log_parser = add_command('log', log)
     # pass HEAD by default in argparse
-    log_parser.add_argument ('oid', default='@', type=oid, nargs='?')
-    
-    diff_parser = commands.add_parser ('diff')
-    diff_parser.set_defaults (func=_diff)
+    log_parser.add_argument ('oid', default='@', nargs='?')
+    log_parser.add_argument ('-n', '--max-count', type=int)
+    log_parser.add_argument ('--skip', type=int, default=0)
+    log_parser.add_argument ('--since', '--after')
+    log_parser.add_argument ('--until', '--before')
+    log_parser.add_argument ('--oneline', action='store_true')
+    
+    diff_parser = add_command('diff', _diff)
     diff_parser.add_argument ('--cached', action='store_true')
     diff_parser.add_argument ('commit', nargs='?')
+    diff_parser.add_argument ('-j', '--jobs', type=int)
     
-    checkout_parser = commands.add_parser ('checkout')
-    checkout_parser.set_defaults (func=checkout)
+    checkout_parser = add_command('checkout', checkout)
     checkout_parser.add_argument ('commit')
     
-    tag_parser = commands.add_parser ('tag')
-    tag_parser.set_defaults (func=tag)
+    tag_parser = add_command('tag', tag)
     tag_parser.add_argument ('name')
     # pass HEAD by default in argparse
-    tag_parser.add_argument ('oid', default='@', type=oid, nargs='?')
+    tag_parser.add_argument ('oid', default='@', nargs='?')
     
     # a visualization tool to see all the mess that we've created, called 'k'
-    k_parser = commands.add_parser ('k')
-    k_parser.set_defaults (func=k)
-    
-    branch_parser = commands.add_parser ('branch')
-    branch_parser.set_defaults (func=branch)
+    k_parser = add_command('k', k)
+    # only the refs matching these globs, e.g. 'refs/heads/*'
+    k_parser.add_argument('refs', nargs='*')
+    k_parser.add_argument('-n', '--max-count', type=int)
+    k_parser.add_argument('--first-parent', action='store_true')
+    # collapse chains of commits without refs or merges into one node
+    k_parser.add_argument('--simplify', action='store_true')
+    k_parser.add_argument('--format', choices=['dot', 'json'], default='dot')
+    k_parser.add_argument('-o', '--output')
+    # show the graph with graphviz instead of printing it
+    k_parser.add_argument('--view', action='store_true')
+    
+    branch_parser = add_command('branch', branch)
     branch_parser.add_argument ('name', nargs='?')
-    branch_parser.add_argument ('start_point', default='@', type=oid, nargs='?')
+    branch_parser.add_argument ('start_point', default='@', nargs='?')
 
-    status_parser = commands.add_parser('status')
-    status_parser.set_defaults(func=status)
-    
-    reset_parser = commands.add_parser ('reset')
-    reset_parser.set_defaults (func=reset)
-    reset_parser.add_argument ('commit', type=oid)
-    
-    show_parser = commands.add_parser('show')
-    show_parser.set_defaults(func=show)
-    show_parser.add_argument('oid', default='@', type=oid, nargs='?')
-    
-    merge_parser = commands.add_parser('merge')
-    merge_parser.set_defaults(func=merge)
-    merge_parser.add_argument('commit', type=oid)
-    
-    merge_base_parser = commands.add_parser('merge-base')
-    merge_base_parser.set_defaults(func=merge_base)
-    merge_base_parser.add_argument('commit1', type=oid)
-    merge_base_parser.add_argument('commit2', type=oid)
-    
-    fetch_parser = commands.add_parser('fetch')
-    fetch_parser.set_defaults(func=fetch)
-    fetch_parser.add_argument('remote')
-    
-    push_parser = commands.add_parser('push')
-    push_parser.set_defaults(func=push)
+    add_command('status', status)
+    
+    reset_parser = add_command('reset', reset)
+    reset_parser.add_argument ('commit')
+    
+    show_parser = add_command('show', show)
+    show_parser.add_argument('oid', default='@', nargs='?')
+    show_parser.add_argument('-j', '--jobs', type=int)
+    
+    merge_parser = add_command('merge', merge)
+    merge_parser.add_argument('commit')
+    
+    merge_base_parser = add_command('merge-base', merge_base)
+    merge_base_parser.add_argument('commit1')
+    merge_base_parser.add_argument('commit2')
+    
+    fetch_parser = add_command('fetch', fetch)
+    # names of remotes (remote.<name>.url in the config) or paths
+    fetch_parser.add_argument('remotes', nargs='*')
+    # every remote in the config
+    fetch_parser.add_argument('--all', action='store_true')
+    # remotes fetched at the same time
+    fetch_parser.add_argument('-j', '--jobs', type=int)
+    # only 'blob:none' (fetch commits and trees, blobs when needed) is supported
+    fetch_parser.add_argument('--filter', choices=['blob:none'])
+    fetch_parser.add_argument('--depth', type=int)
+    
+    # a new repository sharing the objects of a local one
+    clone_parser = add_command('clone', clone)
+    clone_parser.add_argument('source')
+    clone_parser.add_argument('dest')
+    # read the objects from source instead of linking them
+    clone_parser.add_argument('--shared', action='store_true')
+    
+    push_parser = add_command('push', push)
     push_parser.add_argument('remote')
     push_parser.add_argument('branch')
     
-    add_parser = commands.add_parser ('add')
-    add_parser.set_defaults (func=add)
+    add_parser = add_command('add', add)
     add_parser.add_argument ('files', nargs='+')
     
-    return parser.parse_args()
+    blame_parser = add_command('blame', blame)
+    blame_parser.add_argument('commit', default='@', nargs='?')
+    blame_parser.add_argument('file')
+    
+    sparse_checkout_parser = add_command('sparse-checkout', sparse_checkout)
+    sparse_checkout_parser.add_argument('action', choices=['set', 'add', 'list', 'disable'])
+    sparse_checkout_parser.add_argument('dirs', nargs='*')
+    
+    config_parser = add_command('config', config)
+    config_parser.add_argument('--unset', action='store_true')
+    config_parser.add_argument('key', nargs='?')
+    config_parser.add_argument('value', nargs='?')
+    
+    # precompute the changed-path filters used by 'log -- <path>'
+    commit_graph_parser = add_command('commit-graph', commit_graph)
+    commit_graph_parser.add_argument('action', choices=['write'])
+    
+    # keep the repository in memory and answer read-only commands
+    daemon_parser = add_command('daemon', daemon)
+    daemon_parser.add_argument('--stop', action='store_true')
+    
+    # record changed paths with inotify, so status/diff/add don't walk everything
+    fsmonitor_parser = add_command('fsmonitor', fsmonitor)
+    fsmonitor_parser.add_argument('--stop', action='store_true')
+    
+    # verify the hashes and the connectivity of all objects
+    fsck_parser = add_command('fsck', fsck)
+    fsck_parser.add_argument('-j', '--jobs', type=int)
+    fsck_parser.add_argument('--incremental', action='store_true')
+    
+    # create commits from a stream of blobs and file changes on stdin
+    add_command('fast-import', fast_import)
+    
+    # search the files of commits, or of the working directory
+    grep_parser = add_command('grep', grep)
+    grep_parser.add_argument('-l', '--files-with-matches', action='store_true')
+    grep_parser.add_argument('-i', '--ignore-case', action='store_true')
+    grep_parser.add_argument('-n', '--line-number', action='store_true')
+    grep_parser.add_argument('-j', '--jobs', type=int)
+    grep_parser.add_argument('pattern')
+    grep_parser.add_argument('commits', nargs='*')
+    
+    if not built:
+        # unknown command, let argparse report it with the full list of choices
+        return parse_args(argv, build_all=True)
+    
+    args = parser.parse_args(argv)
+    args.paths = paths
+    return args
+
+def _oid(name):
+    """
+    resolve a name (ref, tag, branch or oid) given on the command line to an oid
+    """
+    from . import base
+    return base.get_oid(name)
     
 def init(args):
     """ 
     init a empty ugit respository
     """
-    base.init()
+    from . import base
+    base.init(args.object_store, args.object_format)
     print(f'Initialized empty ugit respository in {os.getcwd()}/{data.GIT_DIR}')
     
 def hash_object(args):
@@ -148,14 +272,51 @@ def cat_file(args):
     
     args.object(): get 'object' argument from command line
     """
+    if args.batch or args.batch_check:
+        return _cat_file_batch(args)
+    assert args.object, 'Object name required'
     sys.stdout.flush()
-    sys.stdout.buffer.write(data.get_object(args.object, expected=None))
+    # big blobs go to stdout without being read into memory
+    try:
+        data.write_object(_oid(args.object), sys.stdout.buffer, expected=None)
+    except BrokenPipeError:
+        _stdout_closed()
+
+def _cat_file_batch(args):
+    """
+    print many objects in a single process: for each name (ref or oid) read from stdin, 
+    print '<oid> <type> <size>' and with --batch the content and a newline,
+    or '<name> missing'
+    """
+    # a batch runs as long as its reader wants, like the daemon
+    data.enable_caches()
+    sys.stdout.flush()
+    try:
+        _cat_file_batch_lines(args, sys.stdout.buffer)
+    except BrokenPipeError:
+        _stdout_closed()
+
+def _cat_file_batch_lines(args, out):
+    from . import base
+    for line in sys.stdin.buffer:
+        name = line.strip().decode()
+        if not name:
+            continue
+        try:
+            oid = base.get_oid(name)
+            data.write_object_batch(oid, out, content=args.batch)
+        except (AssertionError, FileNotFoundError):
+            out.write(f'{name} missing\n'.encode())
+        if not args.buffer:
+            out.flush()
+    out.flush()
 
 def write_tree(args):
     """
     take the current working directory 
     and store it to the object database
     """
+    from . import base
     print(base.write_tree())
 
 def read_tree(args):
@@ -163,23 +324,88 @@ def read_tree(args):
     take an OID of a tree and extract it to the working directory. 
     (the opposite of write-tree)
     """
-    base.read_tree(args.tree)
+    from . import base
+    base.read_tree(_oid(args.tree))
 
 def commit(args):
     """
     command that will accept a commit message, 
     snapshot the current directory and save the resulting object.
     """
+    from . import base
     print(base.commit(args.message))
 
+def _format_commit(oid, commit, refs=None, oneline=False):
+    """
+    :return: the commit info as printed by log and show
+    """
+    import textwrap
+    if oneline:
+        refs_str = f' ({", ".join(refs)})' if refs else ''
+        summary = commit.message.split('\n', 1)[0]
+        return f'{oid[:10]}{refs_str} {summary}\n'
+    refs_str = f'({", ".join(refs)})' if refs else ''
+    date_str = f'Date:   {_format_time(commit.time)}\n' if commit.time else ''
+    return (f'commit {oid}{refs_str}\n{date_str}\n'
+            f'{textwrap.indent(commit.message, "    ")}\n\n')
+
+def _format_time(timestamp):
+    """
+    format (seconds, '+hhmm') in the commit's own timezone, like git does
+    """
+    import datetime
+    seconds, offset = timestamp
+    minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+    tz = datetime.timezone(datetime.timedelta(
+        minutes=-minutes if offset[0] == '-' else minutes))
+    date = datetime.datetime.fromtimestamp(seconds, tz)
+    return f'{date:%a %b %d %H:%M:%S %Y} {offset}'
+
 def _print_commit(oid, commit, refs=None):
     """
     print commit info
     """
-    refs_str = f'({", ".join(refs)})' if refs else ''
-    print(f'commit {oid}{refs_str}\n')
-    print(textwrap.indent(commit.message, '    '))
-    print('')
+    print(_format_commit(oid, commit, refs), end='')
+
+def _parse_date(value):
+    """
+    parse a date given on the command line to seconds since epoch
+    
+    accepts '@<seconds>', ISO dates ('2023-10-19', '2023-10-19 12:00')
+    and relative dates ('3 days ago')
+    """
+    import datetime
+    import re
+    if value.startswith('@'):
+        return int(value[1:])
+    relative = re.fullmatch(r'(\d+)\s*(second|minute|hour|day|week)s?\s+ago', value.strip())
+    if relative:
+        count, unit = relative.groups()
+        delta = datetime.timedelta(**{f'{unit}s': int(count)})
+        return int((datetime.datetime.now() - delta).timestamp())
+    try:
+        return int(datetime.datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        assert False, f'Unknown date {value}'
+
+def _write_output(chunks):
+    """
+    write strings (or bytes) to stdout as they are generated, 
+    stop pulling from 'chunks' as soon as stdout is closed (e.g. by 'head')
+    """
+    sys.stdout.flush()
+    out = sys.stdout.buffer
+    try:
+        for chunk in chunks:
+            out.write(chunk if isinstance(chunk, bytes) else chunk.encode())
+        out.flush()
+    except BrokenPipeError:
+        _stdout_closed()
+
+def _stdout_closed():
+    # Python would complain again when flushing stdout at exit
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
 
 def log(args):
     """
@@ -187,35 +413,63 @@ def log(args):
     
     start from the HEAD commit or input oid from CLI
     and walk its parents until we reach a commit without a parent
+    
+    with paths (after '--'), only print the commits that changed one of them
+    
+    the history is walked lazily, so with -n (or when the reader goes away)
+    only the printed commits are read
     """
+    import itertools
+    from . import base
+    oid = _oid(args.oid)
+    # 0 (@0) is a date too
+    since = None if args.since is None else _parse_date(args.since)
+    until = None if args.until is None else _parse_date(args.until)
     refs = {}
     for refname, ref in data.iter_refs():
         # 1 oid vs. more ref (may be 0)
         refs.setdefault(ref.value, []).append(refname)
         
-    for oid in base.iter_commits_and_parents({args.oid}):
-        commit = base.get_commit(oid)
-        _print_commit(oid, commit, refs.get(oid))
+    if args.paths:
+        from . import commit_graph
+        oids = commit_graph.iter_commits_touching({oid}, args.paths, since)
+    else:
+        # with since, the walk stops at the commits older than it
+        oids = base.iter_commits_and_parents({oid}, since=since)
+    commits = ((oid, base.get_commit(oid)) for oid in oids)
+    if since is not None or until is not None:
+        # commits without a time can't be placed in the range
+        commits = ((oid, commit) for oid, commit in commits
+                   if commit.time
+                   and (since is None or commit.time[0] >= since)
+                   and (until is None or commit.time[0] <= until))
+    stop = None if args.max_count is None else args.skip + args.max_count
+    commits = itertools.islice(commits, args.skip, stop)
+    _write_output(_format_commit(oid, commit, refs.get(oid), args.oneline)
+                  for oid, commit in commits)
 
 def show(args):
     """
     show the commit message and the textual diff from the last commit
     """
-    if not args.oid:
+    from . import base
+    from . import diff
+    oid = _oid(args.oid)
+    if not oid:
         return 
-    commit = base.get_commit(args.oid)
+    commit = base.get_commit(oid)
     parent_tree = None
-    if commit.parents:
+    # the parents of shallow commits weren't fetched
+    if commit.parents and oid not in data.get_shallow():
         parent_tree = base.get_commit(commit.parents[0]).tree
         
-    _print_commit(args.oid, commit)
-    result = diff.diff_trees(
-        base.get_tree(parent_tree), 
-        base.get_tree(commit.tree))
+    _print_commit(oid, commit)
     # Since "diff"'s output is a byte string, 
-    # output it raw to stdout using sys.stdout.buffer.write()
-    sys.stdout.flush ()
-    sys.stdout.buffer.write (result)
+    # output it raw to stdout, file by file as the diffs are made
+    _write_output(diff.diff_trees(
+        base.get_tree(parent_tree), 
+        base.get_tree(commit.tree),
+        _diff_jobs(args), _detect_renames()))
 
 def _diff(args):
     """
@@ -225,13 +479,15 @@ def _diff(args):
         --specific ommit: diff from the commit to the index or working directory
                             (depending on whether --cached was provided).
     """
+    from . import base
+    from . import diff
     oid = args.commit and base.get_oid (args.commit)
     
     if args.commit:
         # If a commit was provided explicitly, diff from it
         tree_from = base.get_tree(oid and base.get_commit(oid).tree)
     
-    if args.cache:
+    if args.cached:
         tree_to = base.get_index_tree()
         if not args.commit:
             # If no commit was provided, diff from HEAD
@@ -242,60 +498,69 @@ def _diff(args):
         if not args.commit:
             # If no commit was provided, diff from index
             tree_from = base.get_index_tree()
+        # files outside of a sparse checkout aren't on disk, but not deleted
+        tree_from = base.filter_sparse(tree_from)
     # compare the "working tree" with the tree of some commit. 
     # The "working tree" is a dictionary that describes the files in the working directory.
-    result = diff.diff_trees(tree_from, tree_to)
-    sys.stdout.flush()
-    sys.stdout.buffer.write(result)
+    _write_output(diff.diff_trees(tree_from, tree_to, _diff_jobs(args)))
+
+def _detect_renames():
+    """
+    whether show and status look for renamed and copied files (the diff.renames setting)
+    """
+    return data.get_config('diff.renames', True) not in (False, 'false')
+
+def _diff_jobs(args):
+    """
+    :return: how many files to diff at the same time: -j, or the diff.jobs setting
+    """
+    if args.jobs is not None:
+        return args.jobs
+    return int(data.get_config('diff.jobs', 1))
     
 def checkout(args):
     """
     move HEAD to point to oid
     """
+    from . import base
     base.checkout(args.commit)
 
 def tag(args):
     """
     create a tag for a oid to remember this oid easily
     """
-    oid = args.oid or data.get_ref('HEAD')
-    base.create_tag(args.name, oid)
+    from . import base
+    base.create_tag(args.name, _oid(args.oid))
 
 def k(args):
     """
     a graphical visualization tool to see all the mess that we've created
-    """
-    dot = 'digraph commits {\n'
-    
-    oids = set()
-    # make tag name point to oid as note, including 'HEAD' tag
-    for refname, ref in data.iter_refs(deref=False):
-        dot += f'"{refname}" [shape=note]\n'
-        dot += f'"{refname}" -> "{ref.value}"\n'
-        # only ono-symbolic refs can be added into the set of oids
-        if not ref.symbolic:
-            oids.add(ref.value)
-    
-    # create a whole graph represent the history commits
-    for oid in base.iter_commits_and_parents(oids):
-        commit = base.get_commit(oid)
-        dot += f'"{oid}" [shape=box style=filled label="{oid[:10]}"]\n'
-        for parent in commit.parents:
-            dot += f'"{oid}" -> "{parent}"\n'
-    
-    dot += '}'
-    print (dot)
-    
-    with subprocess.Popen (
-            ['dot', '-Txlib', '/dev/stdin'],
-            stdin=subprocess.PIPE) as proc:
-        proc.communicate (dot.encode ())
+
+    the graph of refs and commits is streamed as DOT (or JSON) to stdout or a file,
+    or shown with graphviz ('dot -Txlib') with --view
+    """
+    from . import graph
+    chunks = graph.export(args.format, args.refs, args.max_count,
+                          args.first_parent, args.simplify)
+    if args.view:
+        import subprocess
+        with subprocess.Popen(['dot', '-Txlib', '/dev/stdin'],
+                              stdin=subprocess.PIPE) as proc:
+            for chunk in chunks:
+                proc.stdin.write(chunk.encode())
+            proc.stdin.close()
+    elif args.output:
+        with open(args.output, 'w') as f:
+            f.writelines(chunks)
+    else:
+        _write_output(chunks)
     
 def branch(args):
     """
     print all branches
     point a branch to a specific OID(args.start_point)
     """
+    from . import base
     if not args.name:
         current = base.get_branch_name()
         for branch in base.iter_branch_names():
@@ -304,13 +569,16 @@ def branch(args):
             print(f'{prefix} {branch}')
         
     else:
-        base.create_branch(args.name, args.start_point)
-        print(f'Branch {args.name} created at {args.start_point[:10]}')
+        start_point = _oid(args.start_point)
+        base.create_branch(args.name, start_point)
+        print(f'Branch {args.name} created at {start_point[:10]}')
     
 def status(args):
     """
     print useful information about our working directory
     """
+    from . import base
+    from . import diff
     HEAD = base.get_oid('@') # default: HEAD
     branch = base.get_branch_name()
     if branch:
@@ -328,13 +596,16 @@ def status(args):
     HEAD_tree = HEAD and base.get_commit(HEAD).tree
     # comparing HEAD and the index tree (show changed files)
     for path, action in diff.iter_change_files(base.get_tree(HEAD_tree),
-                                                base.get_index_tree ()):
+                                                base.get_index_tree (),
+                                                _detect_renames()):
         print(f'{action:>12}: {path}')
 
     print('\nChanges not staged for commit:\n')
     # comparing the index tree and the working directory (show changed files)
-    for path, action in diff.iter_changed_files(base.get_index_tree(),
-                                                base.get_working_tree()):
+    # files outside of a sparse checkout aren't on disk, but not deleted
+    for path, action in diff.iter_change_files(base.filter_sparse(base.get_index_tree()),
+                                                base.get_working_tree(),
+                                                _detect_renames()):
         print(f'{action:>12}: {path}')
 
 def reset(args):
@@ -349,26 +620,42 @@ def reset(args):
         That's why we need reset, to move the actual branch and 
         not just HEAD.
     """
-    base.reset(args.commit)
+    from . import base
+    base.reset(_oid(args.commit))
     
 def merge(args):
     """
     bring the parallel branches back together
     """
-    base.merge(args.commit)
+    from . import base
+    base.merge(_oid(args.commit))
 
 def merge_base (args):
     """
     receive two commit OIDs and find their common ancestor
     """
-    print(base.get_merge_base(args.commit1, args.commit2))
+    from . import base
+    print(base.get_merge_base(_oid(args.commit1), _oid(args.commit2)))
 
 def fetch(args):
     """
-    download refs and associated objects from a remote repository
+    download refs and associated objects from remote repositories, at the same time
     (only support remote repositories that are located on the same filesystem)
     """
-    remote.fetch(args.remote)
+    from . import remote
+    remotes = remote.get_remote_names() if args.all else args.remotes
+    assert remotes, 'No remote to fetch from'
+    remote.fetch_remotes(remotes, blobs=args.filter != 'blob:none', depth=args.depth,
+                         jobs=args.jobs)
+
+def clone(args):
+    """
+    make a copy of a local repository, hardlinking its objects (or sharing them with --shared)
+    """
+    from . import remote
+    counts = remote.clone(args.source, args.dest, args.shared)
+    linked = ', '.join(f'{count} {method}' for method, count in sorted(counts.items()))
+    print(f'Cloned into {args.dest}' + (f' (objects: {linked})' if linked else ''))
 
 def push(args):
     """
@@ -377,10 +664,147 @@ def push(args):
     when you've added some commits and you'd like to update a remote repository 
     so that it's synchronized with your local version
     """
-    remote.push(args.remote, f'refs/heads/{args.branch}')
+    from . import remote
+    remote.push(remote.get_remote_path(args.remote), f'refs/heads/{args.branch}')
     
 def add(args):
     """
     add files that we want to commit to *index*, which can allow finer grained control over commited files
     """
-    base.add(args.files)
\ No newline at end of file
+    from . import base
+    base.add(args.files)
+
+def blame(args):
+    """
+    show the commit that introduced each line of a file
+    """
+    import datetime
+    from . import blame
+    lines = blame.iter_blame_lines(args.file, _oid(args.commit))
+    
+    def format_line(number, entry):
+        oid, commit, _, line = entry
+        date = ''
+        if commit.time:
+            date = datetime.datetime.fromtimestamp(commit.time[0]).strftime('%Y-%m-%d ')
+        return f'{oid[:10]} ({date}{number:>4}) {line.decode(errors="replace")}\n'
+    
+    _write_output(format_line(number, entry) for number, entry in enumerate(lines, 1))
+
+def sparse_checkout(args):
+    """
+    only check out the top-level files and the given directories
+    
+        set <dir>...: check out only these directories
+        add <dir>...: check out these directories too
+        list: print the directories
+        disable: check out the whole tree again
+    """
+    from . import base
+    dirs = data.get_sparse_dirs()
+    if args.action == 'list':
+        for dirname in sorted(dirs or ()):
+            print(dirname)
+    elif args.action == 'disable':
+        base.set_sparse_checkout(None)
+    elif args.action == 'add':
+        base.set_sparse_checkout(set(dirs or ()) | set(args.dirs))
+    else:
+        base.set_sparse_checkout(args.dirs)
+
+def config(args):
+    """
+    print all settings, print one setting, or change it
+    (e.g. 'ugit config core.chunkThreshold 1048576' to chunk blobs of 1 MiB or more)
+    """
+    if not args.key:
+        import json
+        if os.path.isfile(f'{data.GIT_DIR}/config'):
+            with open(f'{data.GIT_DIR}/config') as f:
+                for key, value in sorted(json.load(f).items()):
+                    print(f'{key}={value}')
+    elif args.unset:
+        data.set_config(args.key, None)
+    elif args.value is None:
+        value = data.get_config(args.key)
+        if value is not None:
+            print(value)
+    else:
+        data.set_config(args.key, args.value)
+
+def commit_graph(args):
+    """
+    write the changed-path filters of all commits reachable from refs
+    """
+    from . import commit_graph
+    print(f'Added {commit_graph.write()} commits to the commit graph')
+
+def daemon(args):
+    """
+    serve read-only commands from memory (refs, index, objects and parsed commits/trees
+    stay cached between commands), or stop the running daemon
+    """
+    from . import daemon
+    if args.stop:
+        if not daemon.stop():
+            print('No daemon is running')
+    else:
+        daemon.serve()
+
+def fsmonitor(args):
+    """
+    watch the working directory and journal the changed paths (Linux only),
+    or stop the running watcher
+    """
+    from . import fsmonitor
+    if args.stop:
+        if not fsmonitor.stop():
+            print('No filesystem monitor is running')
+    else:
+        fsmonitor.watch()
+
+def fsck(args):
+    """
+    report corrupt, missing and dangling objects, exit with 1 if any is corrupt or missing
+    (with --incremental, the objects verified by an earlier run aren't hashed again)
+    """
+    from . import fsck
+    report = fsck.fsck(args.jobs, args.incremental)
+    for oid, problem in report.corrupt:
+        print(f'corrupt {oid}: {problem}')
+    for type_, oid in report.missing:
+        print(f'missing {type_} {oid}')
+    for type_, oid in report.dangling:
+        print(f'dangling {type_} {oid}')
+    print(f'Checked {report.checked} objects, {report.skipped} already verified',
+          file=sys.stderr)
+    if report.corrupt or report.missing:
+        sys.exit(1)
+
+def fast_import(args):
+    """
+    import the history described on stdin (see ugit/fast_import.py for the format)
+    """
+    from . import fast_import
+    blobs, commits = fast_import.fast_import(sys.stdin.buffer)
+    print(f'Imported {blobs} blobs and {commits} commits')
+
+def grep(args):
+    """
+    print the lines matching a regular expression in the files of the commits
+    ('commit:path:line'), or of the working directory; exit with 1 if none matches
+    """
+    from . import grep
+    lines = grep.grep(args.pattern, args.commits, args.ignore_case,
+                      args.files_with_matches, args.line_number, args.jobs)
+    found = False
+
+    def output():
+        nonlocal found
+        for line in lines:
+            found = True
+            yield line
+
+    _write_output(output())
+    if not found:
+        sys.exit(1)
@@ -0,0 +1,152 @@
+"""
+contain the commit graph: a per-commit index of changed-path Bloom filters
+
+For every commit, the paths changed against its first parent (plus all of
+their parent directories) are added to a small Bloom filter, stored in
+.ugit/commit-graph. 'log -- <path>' can then skip commits whose filter
+says the path certainly didn't change, without reading any tree.
+A filter only answers "maybe", so commits that pass it are checked for real.
+"""
+import hashlib
+import json
+import os
+
+from contextlib import contextmanager
+
+from . import base
+from . import data
+
+BITS_PER_ENTRY = 10
+HASH_COUNT = 7
+MIN_FILTER_BYTES = 8
+# commits changing more paths than this get no filter (always "maybe"),
+# a filter that big would be slower than reading the trees
+MAX_CHANGED_PATHS = 512
+
+
+def _graph_path():
+    return f'{data.GIT_DIR}/commit-graph'
+
+def _read_graph():
+    try:
+        with open(_graph_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # none yet, or unreadable: its filters are computed again
+        return {}
+
+@contextmanager
+def open_graph():
+    """
+    read the commit graph {commit oid: filter}, and write it back
+    if filters were added
+    """
+    graph = _read_graph()
+    size = len(graph)
+
+    try:
+        yield graph
+    finally:
+        # also when the caller stopped early, the new filters are still right
+        if len(graph) != size:
+            with data._locked(_graph_path()) as lock:
+                # keep the filters another process added in the meantime
+                lock.commit(json.dumps({**_read_graph(), **graph}))
+
+def _bit_positions(path, nbits):
+    # double hashing: k positions out of two 64 bit hashes
+    digest = hashlib.blake2b(path.encode(), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return ((h1 + i * h2) % nbits for i in range(HASH_COUNT))
+
+def make_filter(paths):
+    """
+    :return: the Bloom filter of 'paths' as a hex string, or None if there are too many
+    """
+    if len(paths) > MAX_CHANGED_PATHS:
+        return None
+    nbytes = max(MIN_FILTER_BYTES, (len(paths) * BITS_PER_ENTRY + 7) // 8)
+    bits = bytearray(nbytes)
+    for path in paths:
+        for pos in _bit_positions(path, nbytes * 8):
+            bits[pos // 8] |= 1 << (pos % 8)
+    return bits.hex()
+
+def maybe_contains(bloom, path):
+    """
+    :return: False if 'path' is certainly not in the filter
+    """
+    if bloom is None:
+        return True
+    bits = bytes.fromhex(bloom)
+    return all(bits[pos // 8] & (1 << (pos % 8))
+               for pos in _bit_positions(path, len(bits) * 8))
+
+def _with_parent_dirs(paths):
+    result = set()
+    for path in paths:
+        parts = path.split('/')
+        result.update('/'.join(parts[:i]) for i in range(1, len(parts) + 1))
+    return result
+
+def _first_parent_tree(oid, commit):
+    # the parents of shallow commits weren't fetched, they are roots
+    if not commit.parents or oid in data.get_shallow():
+        return None
+    return base.get_commit(commit.parents[0]).tree
+
+def get_filter(graph, oid):
+    """
+    :return: the filter of the commit 'oid', computed and added to the graph if missing
+    """
+    if oid not in graph:
+        commit = base.get_commit(oid)
+        changed = base.iter_changed_paths(_first_parent_tree(oid, commit), commit.tree)
+        bloom = make_filter(_with_parent_dirs(changed))
+        if oid in data.get_shallow():
+            # a deeper fetch gives it a parent, and other changed paths
+            return bloom
+        graph[oid] = bloom
+    return graph[oid]
+
+def touches(oid, path):
+    """
+    if the commit 'oid' changed 'path' (a file or a directory) against its first parent
+    """
+    commit = base.get_commit(oid)
+    return (base.get_tree_entry(_first_parent_tree(oid, commit), path) !=
+            base.get_tree_entry(commit.tree, path))
+
+def iter_commits_touching(oids, paths, since=None):
+    """
+    like base.iter_commits_and_parents, but only yield the commits that changed
+    one of 'paths'
+
+    :since: see base.iter_commits_and_parents
+    """
+    # relative to the top of the working directory, like tree paths
+    paths = [os.path.relpath(path) for path in paths]
+    if '.' in paths:
+        # the whole tree: every commit
+        yield from base.iter_commits_and_parents(oids, since=since)
+        return
+    with open_graph() as graph:
+        for oid in base.iter_commits_and_parents(oids, since=since):
+            bloom = get_filter(graph, oid)
+            if any(maybe_contains(bloom, path) and touches(oid, path)
+                   for path in paths):
+                yield oid
+
+def write():
+    """
+    compute the filters of every commit reachable from a ref
+
+    :return: the number of commits added to the graph
+    """
+    oids = {ref.value for _, ref in data.iter_refs()}
+    with open_graph() as graph:
+        size = len(graph)
+        for oid in base.iter_commits_and_parents(oids):
+            get_filter(graph, oid)
+        return len(graph) - size
@@ -0,0 +1,172 @@
+"""
+contain the optional background daemon that keeps a repository warm in memory
+
+'ugit daemon' listens on .ugit/daemon.sock with data's caches enabled
+(refs, index, objects, parsed commits and trees, working tree oids),
+and the CLI forwards read-only commands to it when the socket exists.
+Cached files are validated with their stat, so changes made by other
+ugit processes (or editors) are picked up on the next command.
+"""
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import traceback
+
+from . import data
+
+# only commands that don't modify the repository are forwarded,
+# everything else always runs in the calling process
+FORWARDED_COMMANDS = {'cat-file', 'log', 'show', 'diff', 'status', 'merge-base'}
+
+
+def _socket_path():
+    return f'{data.GIT_DIR}/daemon.sock'
+
+def _send_result(wfile, status, stdout, stderr):
+    header = {'status': status, 'stdout': len(stdout), 'stderr': len(stderr)}
+    wfile.write(b''.join((json.dumps(header).encode(), b'\n', stdout, stderr)))
+
+def _run_command(argv):
+    """
+    run one CLI command in this process, capturing its output
+
+    :return: (exit status, stdout bytes, stderr bytes)
+    """
+    from . import cli
+
+    stdout, stderr = io.BytesIO(), io.BytesIO()
+    old_stdout, old_stderr = sys.stdout, sys.stderr
+    # commands write both text (print) and bytes (sys.stdout.buffer),
+    # write_through keeps the two in order
+    sys.stdout = io.TextIOWrapper(stdout, write_through=True)
+    sys.stderr = io.TextIOWrapper(stderr, write_through=True)
+    status = 0
+    try:
+        args = cli.parse_args(argv)
+        args.func(args)
+    except SystemExit as e:
+        # like the interpreter: None is success, anything else than a
+        # status is a message for stderr
+        if e.code is None:
+            status = 0
+        elif isinstance(e.code, int):
+            status = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            status = 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        # detach, or the wrappers would close the buffers when collected
+        sys.stdout.detach()
+        sys.stderr.detach()
+        sys.stdout, sys.stderr = old_stdout, old_stderr
+    return status, stdout.getvalue(), stderr.getvalue()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # just checking whether the daemon is up
+            return
+        request = json.loads(line)
+        try:
+            if request.get('stop'):
+                self.server.stopping = True
+                _send_result(self.wfile, 0, b'', b'')
+            else:
+                _send_result(self.wfile, *_run_command(request['argv']))
+        except (BrokenPipeError, ConnectionResetError):
+            # the client went away (e.g. 'ugit log | head')
+            pass
+
+
+def serve():
+    """
+    serve commands of the repository in the current directory until stopped
+
+    requests are handled one at a time, since commands rely on
+    global state (data.GIT_DIR, the current directory)
+    """
+    path = _socket_path()
+    if os.path.exists(path):
+        # a stale socket from a daemon that didn't exit cleanly
+        assert not _is_running(), 'A daemon is already running'
+        os.remove(path)
+
+    data.enable_caches()
+    with socketserver.UnixStreamServer(path, _Handler) as server:
+        server.stopping = False
+        try:
+            while not server.stopping:
+                server.handle_request()
+        finally:
+            os.remove(path)
+
+def _is_running():
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(_socket_path())
+    except (FileNotFoundError, ConnectionRefusedError):
+        return False
+    return True
+
+def _request(request):
+    """
+    send a request to the daemon
+
+    :return: (exit status, stdout bytes, stderr bytes),
+             or None if no daemon is listening
+    """
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(_socket_path())
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+
+    with sock, sock.makefile('rwb') as f:
+        f.write(json.dumps(request).encode() + b'\n')
+        f.flush()
+        header = json.loads(f.readline())
+        stdout = f.read(header['stdout'])
+        stderr = f.read(header['stderr'])
+    return header['status'], stdout, stderr
+
+def stop():
+    """
+    ask the running daemon to exit
+
+    :return: whether a daemon was running
+    """
+    return _request({'stop': True}) is not None
+
+def forward(argv):
+    """
+    run a command in the daemon and write its output as if it ran here
+
+    :return: the exit status, or None if the command must run locally
+    """
+    if not argv or argv[0] not in FORWARDED_COMMANDS:
+        return None
+    if os.environ.get('UGIT_NO_DAEMON'):
+        return None
+    if '--batch' in argv or '--batch-check' in argv:
+        # batches read stdin, which isn't forwarded
+        return None
+
+    result = _request({'argv': argv})
+    if result is None:
+        return None
+    status, stdout, stderr = result
+    sys.stdout.buffer.write(stdout)
+    sys.stdout.flush()
+    sys.stderr.buffer.write(stderr)
+    sys.stderr.flush()
+    return status
@@ -3,16 +3,52 @@ Manages the data in .ugit directory.
 Here will be the code that actually touches files on disk.
 """
 import os
-import hashlib
-import json
+import time
 
-from collections import namedtuple
+from collections import defaultdict, namedtuple
 from contextlib import contextmanager
-import shutil
+
+# hashlib, json and shutil are imported where they are used:
+# read-only commands like 'cat-file' never need them and they
+# are a noticeable part of the startup time
 
 # Will be initialized in cli.main()
 GIT_DIR = None
 
+# blobs at least this big are stored as content-defined chunks,
+# unless core.chunkThreshold says otherwise (0 disables chunking)
+DEFAULT_CHUNK_THRESHOLD = 0
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# the repository format this code understands: version 1 reads extensions.*
+# settings, like extensions.objectFormat (version 0 repositories are always sha1)
+REPOSITORY_FORMAT_VERSION = 1
+# object formats (hash algorithms of oids) and the length of their hex oids
+OBJECT_FORMATS = {'sha1': 40, 'sha256': 64, 'blake2b': 64}
+
+# in-memory caches, only enabled by long-running processes (see daemon.py)
+_caches = None
+# objects bigger than this are never kept in memory
+CACHE_MAX_OBJECT_SIZE = 1024 * 1024
+# the object cache (and the other caches of immutable objects) is dropped
+# when it holds more entries than this
+CACHE_MAX_OBJECTS = 50000
+# parsed trees are whole {path: oid} dicts, far fewer of them are kept
+CACHE_MAX_TREES = 256
+# a file modified this recently may still change without its stat changing
+# ("racily clean"), so it isn't cached yet
+RACY_NS = 2 * 10**9
+
+# objects at least this big are written out with sendfile() (see write_object()),
+# smaller ones are cheaper to copy through the output's buffer
+SENDFILE_MIN_SIZE = 64 * 1024
+
+# how long to wait for another process to release a lock (core.lockTimeout, seconds)
+DEFAULT_LOCK_TIMEOUT = 5.0
+# lock contention counters of this process, printed to stderr at exit
+# when UGIT_LOCK_STATS is set (see cli.main())
+lock_stats = {'acquired': 0, 'contended': 0, 'wait_ns': 0, 'timeouts': 0}
+
 
 # allow the change to be performed in a with statement so that directory changes are easily stackable and revertible.
 @contextmanager
@@ -26,24 +62,317 @@ def change_git_dir (new_dir):
     yield
     GIT_DIR = old_dir
 
-def init():
+def enable_caches():
+    """
+    keep refs, the index and objects in memory between commands
+    
+    only safe for a process that stays up: entries of files are validated
+    with their stat, objects are immutable so they never need invalidation
+    """
+    global _caches
+    _caches = defaultdict(dict)
+
+def get_cache(name):
+    """
+    :return: the dict for the cache called 'name' for the current GIT_DIR, 
+             or None if caches aren't enabled
+    """
+    if _caches is None:
+        return None
+    return _caches[GIT_DIR, name]
+
+def cache_add(cache, key, value, max_entries=None):
+    """
+    add an entry to a cache of immutable values, dropping the cache first
+    if it is full, so that it doesn't grow without limit
+
+    :max_entries: CACHE_MAX_OBJECTS by default
+    """
+    if len(cache) >= (max_entries or CACHE_MAX_OBJECTS):
+        cache.clear()
+    cache[key] = value
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+def cached_by_stat(cache, path, load):
+    """
+    :return: load(), or what it returned last time if 'path' hasn't changed since
+    """
+    if cache is None:
+        return load()
+    key = _stat_key(path)
+    entry = cache.get(path)
+    if entry and entry[0] == key:
+        return entry[1]
+    value = load()
+    if key is None or time.time_ns() - key[0] > RACY_NS:
+        cache[path] = (key, value)
+    else:
+        cache.pop(path, None)
+    return value
+
+def init(object_store='loose', object_format='sha1'):
+    """
+    :object_store: where objects are kept, 'loose' or 'sqlite' (see object_store.py)
+    :object_format: the hash of oids, one of OBJECT_FORMATS
+    """
+    assert object_format in OBJECT_FORMATS, f'Unknown object format {object_format}'
     os.makedirs(GIT_DIR)
-    os.makedirs(f'{GIT_DIR}/objects')
+    if object_format != 'sha1':
+        # older versions of ugit would hash with sha1, they must refuse the repository
+        set_config('core.repositoryFormatVersion', REPOSITORY_FORMAT_VERSION)
+        set_config('extensions.objectFormat', object_format)
+    if object_store != 'loose':
+        set_config('core.objectStore', object_store)
+    get_store(object_store).create()
+
+def get_object_format():
+    """
+    :return: the hash algorithm of the oids of the current repository
+    """
+    version = int(get_config('core.repositoryFormatVersion', 0))
+    assert version <= REPOSITORY_FORMAT_VERSION, \
+        f'Unsupported repository format version {version}'
+    if not version:
+        return 'sha1'
+    object_format = get_config('extensions.objectFormat', 'sha1')
+    assert object_format in OBJECT_FORMATS, f'Unknown object format {object_format}'
+    return object_format
+
+def new_hasher(object_format=None):
+    """
+    :return: a hashlib object for oids of 'object_format' (the current repository's by default)
+    """
+    import hashlib
+    object_format = object_format or get_object_format()
+    if object_format == 'blake2b':
+        # 256 bits, like sha256
+        return hashlib.blake2b(digest_size=32)
+    return getattr(hashlib, object_format)()
+
+def oid_length():
+    """
+    :return: the length of the hex oids of the current repository
+    """
+    return OBJECT_FORMATS[get_object_format()]
+
+def get_store(kind=None):
+    """
+    :return: the object store of the current repository
+    """
+    from . import object_store
+    return object_store.open_store(GIT_DIR, kind)
+
+def get_alternates():
+    """
+    :return: the .ugit directories of other repositories whose objects this
+             one uses too (read-only), listed in .ugit/alternates (see 'ugit clone --shared')
+    """
+    def load():
+        if not os.path.isfile(f'{GIT_DIR}/alternates'):
+            return []
+        with open(f'{GIT_DIR}/alternates') as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith('#')]
     
+    # read whenever an object isn't in the repository's own store
+    return cached_by_stat(_alternates_cache, f'{GIT_DIR}/alternates', load)
+
+def add_alternate(git_dir):
+    """
+    use the objects of the repository in git_dir (its .ugit directory)
+    """
+    with _locked(f'{GIT_DIR}/alternates') as lock:
+        alternates = get_alternates()
+        git_dir = os.path.abspath(git_dir)
+        if git_dir not in alternates:
+            lock.commit(''.join(f'{path}\n' for path in alternates + [git_dir]))
+
+def _find_store(oid):
+    """
+    :return: the store that has the object: the repository's own, or the one of
+             an alternate; None if none has it
+    """
+    from . import object_store
+    store = get_store()
+    if store.exists(oid):
+        return store
+    for git_dir in get_alternates():
+        alternate = object_store.open_store(git_dir)
+        if alternate.exists(oid):
+            return alternate
+    return None
+
+def batch_objects():
+    """
+    a context in which the objects written are stored together (one
+    transaction in a SQLite store), use it around writing many objects
+    """
+    return get_store().batch()
+
+_config_cache = {}
+_alternates_cache = {}
+
+def get_config(key, default=None):
+    """
+    read a setting from .ugit/config, a JSON dict of 'section.name': value
+    """
+    return _load_config().get(key, default)
+
+def iter_config(prefix=''):
+    """
+    :return: a generator of the (key, value) settings whose key starts with prefix
+    """
+    for key, value in sorted(_load_config().items()):
+        if key.startswith(prefix):
+            yield key, value
+
+def _load_config():
+    def load():
+        import json
+        if not os.path.isfile(f'{GIT_DIR}/config'):
+            return {}
+        with open(f'{GIT_DIR}/config') as f:
+            return json.load(f)
+    
+    # read for every object written, so cached even when caches are off
+    # (the stat check keeps it right when another process changes it)
+    cache = get_cache('config')
+    return cached_by_stat(_config_cache if cache is None else cache,
+                          f'{GIT_DIR}/config', load)
+
+def set_config(key, value):
+    """
+    write a setting to .ugit/config, a value of None removes it
+    """
+    import json
+    with _locked(f'{GIT_DIR}/config') as lock:
+        config = {}
+        if os.path.isfile(f'{GIT_DIR}/config'):
+            with open(f'{GIT_DIR}/config') as f:
+                config = json.load(f)
+        if value is None:
+            config.pop(key, None)
+        else:
+            config[key] = value
+        lock.commit(json.dumps(config, indent=4, sort_keys=True))
+    
+class _Lock:
+    """
+    the lock of a file: '<path>.lock', created exclusively. The new content is
+    written to the lock file, which then replaces the file in one rename,
+    so readers never need a lock: they see the old file or the new one
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = f'{path}.lock'
+        self.fd = None
+
+    def acquire(self):
+        timeout = float(get_config('core.lockTimeout', DEFAULT_LOCK_TIMEOUT))
+        start = time.monotonic_ns()
+        delay = 0.001
+        contended = False
+        while True:
+            try:
+                self.fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+                break
+            except FileExistsError:
+                contended = True
+                if time.monotonic_ns() - start > timeout * 10**9:
+                    lock_stats['timeouts'] += 1
+                    assert False, (f'Unable to lock {self.path}: {self.lock_path} exists. '
+                                   'If no other ugit process is running, remove it')
+                # back off exponentially, the holder is usually done within milliseconds
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+        lock_stats['acquired'] += 1
+        if contended:
+            lock_stats['contended'] += 1
+            lock_stats['wait_ns'] += time.monotonic_ns() - start
+
+    def commit(self, content):
+        """
+        replace the file with 'content' (str), and release the lock
+        """
+        with os.fdopen(self.fd, 'w') as f:
+            self.fd = None
+            f.write(content)
+        os.replace(self.lock_path, self.path)
+
+    def delete(self):
+        """
+        remove the file, and release the lock
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.release()
+
+    def release(self):
+        """
+        give the lock up without changing the file (does nothing after commit())
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            os.remove(self.lock_path)
+
+@contextmanager
+def _locked(path):
+    """
+    hold the lock of 'path' for the block, which ends it with commit() or delete();
+    otherwise (or on an error) the file is left as it was
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    lock = _Lock(path)
+    lock.acquire()
+    try:
+        yield lock
+    finally:
+        lock.release()
+
+def format_lock_stats():
+    return ('lock stats: {acquired} acquired, {contended} contended, '
+            '{wait_ms:.1f} ms waiting, {timeouts} timed out').format(
+                wait_ms=lock_stats['wait_ns'] / 10**6, **lock_stats)
+
 @contextmanager
-def get_index():
+def get_index(write=True):
     """
     read and write the index in JSON format
+
+    :write: if False, only read it, without taking the lock
+            (changes to the yielded dict are then lost)
     """
-    index = {}
-    if os.path.isfile(f'{GIT_DIR}/index'):
+    import json
+    
+    def load():
+        if not os.path.isfile(f'{GIT_DIR}/index'):
+            return {}
         with open(f'{GIT_DIR}/index') as f:
-            index = json.load(f)
+            return json.load(f)
+    
+    if not write:
+        yield dict(cached_by_stat(get_cache('index'), f'{GIT_DIR}/index', load))
+        return
 
-    yield index
+    # locked before reading, so that an update made by another process
+    # in the meantime can't be overwritten
+    with _locked(f'{GIT_DIR}/index') as lock:
+        cached = cached_by_stat(get_cache('index'), f'{GIT_DIR}/index', load)
+        index = dict(cached)
 
-    with open(f'{GIT_DIR}/index', 'w') as f:
-        json.dump(index, f)
+        yield index
+
+        if index == cached and os.path.isfile(f'{GIT_DIR}/index'):
+            # nothing changed, keep the file (and so the cache entry) as it is
+            return
+        lock.commit(json.dumps(index))
 
 def hash_object(data, type_='blob'):
     """ 
@@ -54,12 +383,178 @@ def hash_object(data, type_='blob'):
     :return: hash id of 'type + data'
     """
     
-    obj = type_.encode() + b'\x00' + data
-    oid = hashlib.sha1(obj).hexdigest()
-    with open(f'{GIT_DIR}/objects/{oid}', 'wb') as out:
-        out.write(obj)
+    header = type_.encode() + b'\x00'
+    # hash the header and the data separately, to not copy big blobs
+    hasher = new_hasher()
+    hasher.update(header)
+    hasher.update(data)
+    oid = hasher.hexdigest()
+    store = get_store()
+    if object_exists(oid):
+        # objects never change, it's already there (maybe in an alternate)
+        return oid
+    
+    threshold = int(get_config('core.chunkThreshold', DEFAULT_CHUNK_THRESHOLD))
+    if type_ == 'blob' and threshold and len(data) >= threshold:
+        _write_chunked(oid, data)
+    else:
+        store.write(oid, header, data)
     return oid
 
+def _write_chunked(oid, data):
+    """
+    store a big blob as 'chunk' objects and a 'chunked' manifest listing them
+    
+    the manifest is stored under the oid of the whole blob, so trees and
+    everything else still see one blob. Chunks that another version of the
+    blob already has are not stored again.
+    """
+    from . import chunking
+    avg_size = int(get_config('core.chunkSize', DEFAULT_CHUNK_SIZE))
+    assert avg_size >= 4, 'core.chunkSize must be at least 4'
+    with batch_objects():
+        manifest = ''.join(f'{hash_object(chunk, "chunk")} {len(chunk)}\n'
+                           for chunk in chunking.iter_chunks(data, avg_size))
+        get_store().write(oid, b'chunked\x00', manifest.encode())
+
+def _read_stored(oid):
+    """
+    :return: (type, content) of the object as it is stored (so maybe 'chunked')
+    """
+    obj = get_store().read(oid)
+    if obj is None:
+        store = _find_store(oid)
+        if store is None:
+            # in a partial clone, blobs are only fetched when they are needed
+            fetch_missing_objects([oid])
+            store = get_store()
+        obj = store.read(oid)
+        assert obj is not None, f'Object {oid} is missing'
+    type_, _, content = obj.partition(b'\x00')
+    return type_.decode(), content
+
+def _parse_manifest(content):
+    return [oid for oid, _ in _parse_manifest_sizes(content)]
+
+def _parse_manifest_sizes(content):
+    # one '<chunk oid> <size>' line per chunk
+    return [(oid, int(size)) for oid, size in
+            (line.split(' ') for line in content.decode().splitlines())]
+
+def iter_object(oid, expected='blob'):
+    """
+    like get_object(), but yield the content in pieces:
+    chunked blobs are read one chunk at a time instead of reassembled in memory
+    """
+    type_, content = _read_stored(oid)
+    if type_ != 'chunked':
+        if expected is not None:
+            assert type_ == expected, f'Expected {expected}, got {type_}'
+        yield content
+        return
+    if expected is not None:
+        assert expected == 'blob', f'Expected {expected}, got blob'
+    for chunk_oid in _parse_manifest(content):
+        yield get_object(chunk_oid, 'chunk')
+
+@contextmanager
+def _open_stored(oid):
+    """
+    yield (type as stored, memoryview of the content, file descriptor or None,
+    offset of the content in the file)
+    """
+    store = _find_store(oid)
+    if store is None:
+        # in a partial clone, blobs are only fetched when they are needed
+        fetch_missing_objects([oid])
+        store = get_store()
+    with store.open_view(oid) as opened:
+        assert opened is not None, f'Object {oid} is missing'
+        view, fd = opened
+        # the header is a short type name, only that much is copied
+        start = bytes(view[:16]).index(b'\x00') + 1
+        with view[start:] as content:
+            yield bytes(view[:start - 1]).decode(), content, fd, start
+
+def write_object(oid, out, expected='blob'):
+    """
+    write the content of an object to the binary file 'out' without holding it in memory:
+    a loose object is copied by the kernel (sendfile) when 'out' is a real file or a pipe,
+    else written from its memory map; a chunked blob is written chunk by chunk
+    """
+    with _open_stored(oid) as (type_, content, fd, start):
+        if type_ == 'chunked':
+            if expected is not None:
+                assert expected == 'blob', f'Expected {expected}, got blob'
+            chunk_oids = _parse_manifest(bytes(content))
+        else:
+            if expected is not None:
+                assert type_ == expected, f'Expected {expected}, got {type_}'
+            _write_content(out, content, fd, start)
+            return
+    for chunk_oid in chunk_oids:
+        write_object(chunk_oid, out, 'chunk')
+
+def write_object_batch(oid, out, content=True):
+    """
+    write '<oid> <type> <size>' and, with content, the content and a newline
+    ('ugit cat-file --batch'), opening the object only once. Objects up to
+    CACHE_MAX_OBJECT_SIZE go through the object cache when caches are enabled
+    """
+    cache = get_cache('objects')
+    if cache is not None and oid in cache:
+        type_, cached = cache[oid]
+        out.write(f'{oid} {type_} {len(cached)}\n'.encode())
+        if content:
+            out.write(cached)
+            out.write(b'\n')
+        return
+    chunks = []
+    with _open_stored(oid) as (type_, view, fd, start):
+        if type_ == 'chunked':
+            chunks = _parse_manifest_sizes(bytes(view))
+            type_, size = 'blob', sum(chunk_size for _, chunk_size in chunks)
+        else:
+            size = len(view)
+            if cache is not None and size <= CACHE_MAX_OBJECT_SIZE:
+                cache_add(cache, oid, (type_, bytes(view)))
+        out.write(f'{oid} {type_} {size}\n'.encode())
+        if content and not chunks:
+            _write_content(out, view, fd, start)
+    if content:
+        for chunk_oid, _ in chunks:
+            write_object(chunk_oid, out, 'chunk')
+        out.write(b'\n')
+
+def _write_content(out, content, fd, start):
+    # big objects with a file are copied by the kernel
+    if (fd is None or len(content) < SENDFILE_MIN_SIZE
+            or not _sendfile(out, fd, start, len(content))):
+        out.write(content)
+
+def _sendfile(out, fd, offset, count):
+    """
+    :return: False if sendfile() can't write to 'out', nothing was written then
+    """
+    try:
+        out_fd = out.fileno()
+    except (AttributeError, OSError):
+        # e.g. a BytesIO (io.UnsupportedOperation is an OSError)
+        return False
+    out.flush()
+    sent = 0
+    while sent < count:
+        try:
+            n = os.sendfile(out_fd, fd, offset + sent, count - sent)
+        except OSError:
+            if sent:
+                raise
+            return False
+        # the file ended early: it was truncated
+        assert n, f'Unexpected end of object file after {sent} of {count} bytes'
+        sent += n
+    return True
+
 def get_object(oid, expected='blob'):
     """ 
     get object by its OID
@@ -67,17 +562,30 @@ def get_object(oid, expected='blob'):
     :expected: expected type
     :return: object's content
     """
-    with open(f'{GIT_DIR}/objects/{oid}', 'rb') as f:
-        obj = f.read()
-        
-    type_, _, content = obj.partition(b'\x00')
-    type_ = type_.decode()
+    return read_object(oid, expected)[1]
+
+def read_object(oid, expected=None):
+    """
+    like get_object()
+    
+    :return: (type, content)
+    """
+    cache = get_cache('objects')
+    if cache is not None and oid in cache:
+        type_, content = cache[oid]
+    else:
+        type_, content = _read_stored(oid)
+        if type_ == 'chunked':
+            # reassemble the blob from its chunks
+            type_, content = 'blob', b''.join(iter_object(oid))
+        if cache is not None and len(content) <= CACHE_MAX_OBJECT_SIZE:
+            cache_add(cache, oid, (type_, content))
     
     if expected is not None:
         # verify type_ is indeed the expected type
         # https://www.w3schools.com/python/ref_keyword_assert.asp
         assert type_ == expected, f'Expected {expected}, got {type_}'
-    return content
+    return type_, content
 
 # create a RefValue container to represent the value of a ref. 
 # RefValue have a property symbolic that will say whether it's a symbolic or a direct ref.
@@ -96,25 +604,18 @@ def get_object(oid, expected='blob'):
 """
 RefValue = namedtuple('RefValue', ['symbolic', 'value'])
 
-def update_ref(ref, value, deref=True):
+def update_ref(ref, value, deref=True, old=None):
     """
     recode the oid in .ugit/{ref} file
     ref == HEAD : make HEAD point to this oid
     ref == refs/tags/ : write oid in tags files to record tags that be provided by the user
+
+    :old: if given, the RefValue the ref must still have (as returned by get_ref(),
+          a value of None for a ref that must not exist yet); checked under the
+          lock, so a concurrent update can't be overwritten
     """
-    # get last non-symbolic ref it needs to update by using _get_ref_internal
-    ref = _get_ref_internal(ref, deref)[0]
-    # write a symbolic value
-    assert value.value
-    if value.symbolic:
-        value = f'ref: {value.value}'
-    else:
-        value = value.value
-    ref_path = f'{GIT_DIR}/{ref}'
-    
-    os.makedirs(os.path.dirname(ref_path), exist_ok=True)
-    with open(ref_path, 'w') as f:
-        f.write(value)
+    with ref_transaction() as transaction:
+        transaction.update(ref, value, old, deref)
         
 def get_ref(ref, deref=True):
     """
@@ -124,12 +625,77 @@ def get_ref(ref, deref=True):
     """
     return _get_ref_internal(ref, deref)[1]
 
-def delete_ref(ref, deref=True):
+def delete_ref(ref, deref=True, old=None):
     """
     removes an existing ref
+
+    :old: like for update_ref()
     """
-    ref = _get_ref_internal(ref, deref)[0]
-    os.remove(f'{GIT_DIR}/{ref}')
+    with ref_transaction() as transaction:
+        transaction.delete(ref, old, deref)
+
+def _format_ref(value):
+    if value.symbolic:
+        return f'ref: {value.value}'
+    return value.value
+
+class _RefTransaction:
+
+    def __init__(self):
+        # resolved ref -> (new RefValue or None to delete, expected old RefValue or None)
+        self.updates = {}
+
+    def update(self, ref, value, old=None, deref=True):
+        assert value.value
+        self.updates[_get_ref_internal(ref, deref)[0]] = (value, old)
+
+    def delete(self, ref, old=None, deref=True):
+        self.updates[_get_ref_internal(ref, deref)[0]] = (None, old)
+
+    def apply(self):
+        # locked in a fixed order, so two transactions can't deadlock
+        refs = sorted(self.updates)
+        locks = []
+        try:
+            for ref in refs:
+                locks.append(_Lock(f'{GIT_DIR}/{ref}'))
+                os.makedirs(os.path.dirname(locks[-1].path), exist_ok=True)
+                locks[-1].acquire()
+                old = self.updates[ref][1]
+                if old is not None:
+                    # read the file itself: the cache can't know about other processes
+                    current = _read_ref_file(locks[-1].path)
+                    expected = _format_ref(old) if old.value else None
+                    assert current == expected, \
+                        f'{ref} changed concurrently: expected {expected}, found {current}'
+            for ref, lock in zip(refs, locks):
+                value = self.updates[ref][0]
+                if value is None:
+                    lock.delete()
+                else:
+                    lock.commit(_format_ref(value))
+        finally:
+            for lock in locks:
+                lock.release()
+
+@contextmanager
+def ref_transaction():
+    """
+    update several refs all together: every ref is locked and every expected
+    old value is checked before any ref changes, if one check fails nothing is written
+
+    :yield: a transaction to call update(ref, value, old=None, deref=True)
+            and delete(ref, old=None, deref=True) on
+    """
+    transaction = _RefTransaction()
+    yield transaction
+    transaction.apply()
+
+def _read_ref_file(ref_path):
+    if not os.path.isfile(ref_path):
+        return None
+    with open(ref_path) as f:
+        return f.read().strip()
 
 def _get_ref_internal(ref, deref=True):
     """
@@ -139,10 +705,7 @@ def _get_ref_internal(ref, deref=True):
     return the path and the value of the ref(passed in as parameter)
     """
     ref_path = f'{GIT_DIR}/{ref}'
-    value = None
-    if os.path.isfile(ref_path):
-        with open(ref_path) as f:
-            value = f.read().strip()
+    value = cached_by_stat(get_cache('refs'), ref_path, lambda: _read_ref_file(ref_path))
 
     # When given a symbolic ref, _get_ref_internal will dereference the ref recursively, 
     #   find the name of the last non-symbolic ref (that points to an OID) and return it,
@@ -167,7 +730,8 @@ def iter_refs(prefix='', deref=True):
     for root, _, filenames in os.walk(f'{GIT_DIR}/refs/'):
         # root = root - GIT_DIR
         root = os.path.relpath(root, GIT_DIR)
-        refs.extend(f'{root}/{name}' for name in filenames)
+        # skip the lock files of refs being updated
+        refs.extend(f'{root}/{name}' for name in filenames if not name.endswith('.lock'))
         
     for refname in refs:
         if not refname.startswith(prefix):
@@ -176,8 +740,57 @@ def iter_refs(prefix='', deref=True):
         if ref.value:
             yield refname, ref
 
+def get_shallow():
+    """
+    :return: the set of shallow commits: commits fetched without their parents 
+             (see remote.fetch()), which history walks treat as roots
+    """
+    def load():
+        if not os.path.isfile(f'{GIT_DIR}/shallow'):
+            return frozenset()
+        with open(f'{GIT_DIR}/shallow') as f:
+            return frozenset(f.read().split())
+    
+    return cached_by_stat(get_cache('shallow'), f'{GIT_DIR}/shallow', load)
+
+def set_shallow(oids):
+    """
+    write the set of shallow commits, one oid per line
+    """
+    with _locked(f'{GIT_DIR}/shallow') as lock:
+        if not oids:
+            lock.delete()
+        else:
+            lock.commit(''.join(f'{oid}\n' for oid in sorted(oids)))
+
+def get_sparse_dirs():
+    """
+    :return: the directories of the sparse checkout (see base.is_sparse_included()),
+             or None if the whole tree is checked out
+    """
+    def load():
+        if not os.path.isfile(f'{GIT_DIR}/sparse-checkout'):
+            return None
+        with open(f'{GIT_DIR}/sparse-checkout') as f:
+            return frozenset(f.read().splitlines())
+    
+    return cached_by_stat(get_cache('sparse'), f'{GIT_DIR}/sparse-checkout', load)
+
+def set_sparse_dirs(dirs):
+    """
+    write the directories of the sparse checkout, None disables it
+    """
+    with _locked(f'{GIT_DIR}/sparse-checkout') as lock:
+        if dirs is None:
+            lock.delete()
+        else:
+            lock.commit(''.join(f'{dirname}\n' for dirname in sorted(dirs)))
+
 def object_exists(oid):
-    return os.path.isfile(f'{GIT_DIR}/objects/{oid}')
+    """
+    :return: whether the object is in the repository or one of its alternates
+    """
+    return _find_store(oid) is not None
 
 
 def fetch_object_if_missing(oid, remote_git_dir):
@@ -186,14 +799,55 @@ def fetch_object_if_missing(oid, remote_git_dir):
     """
     if object_exists(oid):
         return
-    remote_git_dir += '/.ugit'
-    shutil.copy(f'{remote_git_dir}/objects/{oid}',
-                f'{GIT_DIR}/objects/{oid}')
+    _copy_object(oid, get_store(), get_remote_store(remote_git_dir))
+
+def get_remote_store(remote_path):
+    """
+    :return: the object store of the repository in the directory remote_path
+    """
+    from . import object_store
+    return object_store.open_store(f'{remote_path}/.ugit')
+
+def _copy_object(oid, to_store, from_store):
+    """
+    copy an object as it is stored between two stores, with its chunks
+    """
+    if to_store.exists(oid):
+        return
+    obj = from_store.read(oid)
+    assert obj is not None, f'Object {oid} is missing'
+    if obj.startswith(b'chunked\x00'):
+        # a chunked blob is of no use without its chunks, copy them first
+        # so that the blob is never there without them
+        for chunk_oid in _parse_manifest(obj.partition(b'\x00')[2]):
+            _copy_object(chunk_oid, to_store, from_store)
+    to_store.write(oid, obj)
+
+def fetch_missing_objects(oids):
+    """
+    fetch the objects of 'oids' that are missing from the promisor remote 
+    (the remote a partial clone was fetched from, see remote.fetch()), 
+    all at once before they are needed one by one
+    
+    :return: whether there is a promisor remote to fetch from
+    """
+    promisor = get_config('remote.promisor')
+    if not promisor:
+        return False
+    missing = [oid for oid in oids if oid and not object_exists(oid)]
+    if missing:
+        with batch_objects():
+            for oid in missing:
+                fetch_object_if_missing(oid, promisor)
+    return True
 
 def push_object(oid, remote_git_dir):
     """
     copy a local object by oid to a remote repository
     """
-    remote_git_dir = '/.ugit'
-    shutil.copy(f'{GIT_DIR}/objects/{oid}',
-                f'f{remote_git_dir}/objects/{oid}')
\ No newline at end of file
+    remote = get_remote_store(remote_git_dir)
+    if remote.exists(oid):
+        return
+    if not object_exists(oid):
+        fetch_missing_objects([oid])
+    _copy_object(oid, remote, _find_store(oid) or get_store())
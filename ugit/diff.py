@@ -25,26 +25,73 @@ def compare_trees(*trees):
     for path, oids in entries.items():
         yield (path, *oids)       
     
-def diff_trees(t_from, t_to):
+def diff_trees(t_from, t_to, jobs=1, renames=False):
     """
     takes two trees, compares them  
-    :return: all entries(file_path) that have different OIDs
+    :jobs: run the diffs of this many files at the same time (in threads,
+           the work is done by the 'diff' processes), still yielded in the
+           same order as without jobs
+    :renames: show renamed and copied files (see find_renames()) as such,
+              diffed against their old version
+    :return: a generator of the diff of each entry(file_path) that has different OIDs
     """
-    output = b''
-    for path, o_form, o_to in compare_trees(t_from, t_to):
-        if o_form != o_to:
-            output += diff_blob(o_form, o_to, path)
-    return output
+    found = find_renames(t_from, t_to) if renames else {}
+    renamed_from = {old for old, action in found.values() if action == 'renamed'}
+    # (old path, new path, old oid, new oid, 'rename'/'copy' or None)
+    changed = []
+    for path, o_from, o_to in compare_trees(t_from, t_to):
+        if o_from == o_to or (path in renamed_from and not o_to):
+            continue
+        if path in found:
+            old, action = found[path]
+            kind = 'copy' if action == 'copied' else 'rename'
+            changed.append((old, path, t_from[old], o_to, kind))
+        else:
+            changed.append((path, path, o_from, o_to, None))
+    # in a partial clone, get the missing blobs in one go
+    data.fetch_missing_objects(oid for _, _, o_from, o_to, _ in changed for oid in (o_from, o_to))
+    if jobs <= 1:
+        for entry in changed:
+            yield _diff_entry(*entry)
+        return
+
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(jobs) as pool:
+        # only a few files ahead of the one being written, so that
+        # memory stays bounded when the reader is slower than the diffs
+        pending = deque()
+        try:
+            for entry in changed:
+                pending.append(pool.submit(_diff_entry, *entry))
+                if len(pending) >= jobs * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # the reader stopped early: don't start the remaining diffs
+            for future in pending:
+                future.cancel()
 
-def diff_blob(o_from, o_to, path='blob'):
+def _diff_entry(path_from, path_to, o_from, o_to, kind):
+    if not kind:
+        return diff_blob(o_from, o_to, path_from)
+    header = f'{kind} from {path_from}\n{kind} to {path_to}\n'.encode()
+    if o_from == o_to:
+        return header
+    return header + diff_blob(o_from, o_to, path_from, path_to)
+
+def diff_blob(o_from, o_to, path='blob', path_to=None):
     """
     take two blob OIDs 
+    :path_to: the path of o_to, if it isn't 'path' (renamed or copied)
     :return: the diff between them
     """
     with Temp() as f_from, Temp() as f_to:
         for oid, f in ((o_from, f_from), (o_to, f_to)):
             if oid:
-                f.write(data.get_object(oid))
+                # copied file to file, big blobs aren't read into memory
+                data.write_object(oid, f)
                 f.flush()
 
         # use an external Unix utility called "diff". 
@@ -53,19 +100,109 @@ def diff_blob(o_from, o_to, path='blob'):
         with subprocess.Popen(
             ['diff', '--unified', '--show-c-function',
              '--label', f'a/{path}', f_from.name,
-             '--label', f'b/{path}', f_to.name],
+             '--label', f'b/{path_to or path}', f_to.name],
             stdout=subprocess.PIPE) as proc:
             output, _ = proc.communicate()
 
         return output
 
-def iter_change_files(t_from, t_to):
+def map_lines(lines_from, lines_to):
+    """
+    take two lists of lines
+    :return: {index in lines_to: index in lines_from} for every line that was kept
+    """
+    # difflib is pure python, but avoids a "diff" process per pair of blobs
+    import difflib
+    matcher = difflib.SequenceMatcher(None, lines_from, lines_to, autojunk=False)
+    result = {}
+    for i_from, i_to, size in matcher.get_matching_blocks():
+        for offset in range(size):
+            result[i_to + offset] = i_from + offset
+    return result
+
+def _empty_blob_oid():
+    # hashed like data.hash_object(b''), without storing it
+    hasher = data.new_hasher()
+    hasher.update(b'blob\x00')
+    return hasher.hexdigest()
+
+def find_renames(t_from, t_to):
+    """
+    find the new files of t_to that were renamed or copied from a file of t_from
+
+    exact moves (same oid) are paired first; the remaining new files are compared
+    with the deleted and modified files through similarity sketches (see
+    similarity.py). Settings: diff.renameThreshold (0 to 1), diff.renameCandidates
+    (sources compared per new file) and diff.renameLimit (above this many new or
+    source files, only exact moves are found)
+
+    :return: {new path: (old path, 'renamed' or 'copied')}
+    """
+    added = {path: oid for path, oid in t_to.items() if path not in t_from}
+    deleted = {path: oid for path, oid in t_from.items() if path not in t_to}
+    # like git, empty files are neither renamed nor copied: any two are "equal"
+    empty = _empty_blob_oid()
+    added = {path: oid for path, oid in added.items() if oid != empty}
+    if not added:
+        return {}
+    result = {}
+    renamed_from = set()
+
+    def pair(new, old):
+        if old in deleted and old not in renamed_from:
+            renamed_from.add(old)
+            result[new] = (old, 'renamed')
+        else:
+            # a deleted file goes to one place, the other ones are copies
+            result[new] = (old, 'copied')
+
+    # exact: prefer the deleted paths, then any unchanged path as a copy
+    by_oid = {}
+    for path, oid in t_from.items():
+        if oid != empty:
+            by_oid.setdefault(oid, []).append(path)
+    for path in sorted(added):
+        olds = by_oid.get(added[path])
+        if olds:
+            gone = [old for old in olds if old in deleted and old not in renamed_from]
+            pair(path, (gone or olds)[0])
+
+    # similar: only the deleted and modified files are sources, like git -C
+    targets = {path: oid for path, oid in added.items() if path not in result}
+    sources = {path: oid for path, oid in t_from.items()
+               if oid != empty and (path in deleted or t_to.get(path, oid) != oid)}
+    limit = int(data.get_config('diff.renameLimit', 20000))
+    if targets and sources and max(len(targets), len(sources)) <= limit:
+        from . import similarity
+        data.fetch_missing_objects([*targets.values(), *sources.values()])
+        pairs = similarity.find_similar(
+            sources, targets,
+            float(data.get_config('diff.renameThreshold', 0.5)),
+            int(data.get_config('diff.renameCandidates', 16)))
+        # best matches first
+        for _, new, old in sorted(pairs, reverse=True):
+            if new not in result:
+                pair(new, old)
+    return result
+
+def iter_change_files(t_from, t_to, renames=False):
     """
     take two trees and output all changed paths along with the change type 
     (deleted, created, modified)
+
+    :renames: also detect renamed and copied files (see find_renames()), which are
+              output as 'old -> new' instead of a deleted and a new file
     """
+    found = find_renames(t_from, t_to) if renames else {}
+    renamed_from = {old for old, action in found.values() if action == 'renamed'}
     for path, o_from, o_to in compare_trees(t_from, t_to):
         if o_from != o_to:
+            if path in found:
+                old, action = found[path]
+                yield f'{old} -> {path}', action
+                continue
+            if path in renamed_from and not o_to:
+                continue
             action = (
                 'new file' if not o_from else
                 'deleted' if not o_to else
@@ -79,6 +216,7 @@ def merge_tree(t_base, t_HEAD, t_other):
     outputting one merged tree
     """
     tree = {}
+    data.fetch_missing_objects(oid for t in (t_base, t_HEAD, t_other) for oid in t.values())
     for path, o_base, o_HEAD, o_other in compare_trees(t_base, t_HEAD, t_other):
         tree[path] = data.hash_object(merge_blobs(o_base, o_HEAD, o_other))
     return tree
@@ -92,7 +230,7 @@ def merge_blobs(o_base, o_HEAD, o_other):
         # write blobs to files
         for oid, f in ((o_base, f_base), (o_HEAD, f_HEAD), (o_other, f_other)):
             if oid:
-                f.write(data.get_object(oid))
+                data.write_object(oid, f)
                 f.flush()
         
         # a helper function that calls the diff shell command
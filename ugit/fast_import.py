@@ -0,0 +1,260 @@
+"""
+contain 'ugit fast-import': create history from a stream instead of add + commit
+
+The stream (read from stdin) is a sequence of commands, each line ends with LF:
+
+    blob
+    mark :<number>
+    data <size>
+    <size bytes of content>
+
+    commit <ref>                    e.g. refs/heads/master
+    mark :<number>                  optional
+    time <seconds> <+hhmm>          optional
+    data <size>
+    <size bytes of commit message>
+    from <:mark or oid>             optional, the first parent; defaults to the
+                                    last commit of <ref> (in the stream or the repo)
+    merge <:mark or oid>            optional, more parents
+    deleteall                       optional, start from an empty tree
+    M <:mark or oid> <path>         set a file
+    D <path>                        delete a file (or a directory)
+                                    <empty line ends the commit>
+
+    reset <ref>
+    from <:mark or oid>             optional, otherwise the ref is deleted
+
+    done                            optional, end of the stream
+
+Objects are written directly, there is no index and no working directory.
+Each commit only writes the trees on the paths it changed, the other
+subtrees keep their oids. Refs are updated once, at the end of the stream.
+"""
+from . import base
+from . import data
+
+
+def _new_dir(oid=None):
+    # a directory of the tree being built: 'oid' is None once it changed,
+    # 'children' ({name: directory or blob oid}) is None until it is read
+    return {'oid': oid, 'children': None if oid else {}}
+
+def _children(node):
+    if node['children'] is None:
+        node['children'] = {}
+        for type_, oid, name in base._iter_tree_entries(node['oid']):
+            node['children'][name] = _new_dir(oid) if type_ == 'tree' else oid
+    return node['children']
+
+def _set_path(root, path, blob_oid):
+    *dirnames, filename = path.split('/')
+    node = root
+    node['oid'] = None
+    for dirname in dirnames:
+        child = _children(node).get(dirname)
+        if not isinstance(child, dict):
+            child = _children(node)[dirname] = _new_dir()
+        node = child
+        node['oid'] = None
+    _children(node)[filename] = blob_oid
+
+def _delete_path(root, path):
+    *dirnames, name = path.split('/')
+    nodes = [root]
+    for dirname in dirnames:
+        child = _children(nodes[-1]).get(dirname)
+        if not isinstance(child, dict):
+            return
+        nodes.append(child)
+    if _children(nodes[-1]).pop(name, None) is None:
+        return
+    for node in nodes:
+        node['oid'] = None
+
+def _write_dir(node):
+    """
+    :return: the oid of the tree of 'node', or None if it's empty,
+             writing only the directories that changed
+    """
+    if node['oid']:
+        return node['oid']
+    entries = []
+    for name, child in _children(node).items():
+        if isinstance(child, dict):
+            oid = _write_dir(child)
+            if oid:
+                entries.append((name, oid, 'tree'))
+        else:
+            entries.append((name, child, 'blob'))
+    if not entries:
+        return None
+    # the same format as base.write_tree(), so the same tree gets the same oid
+    tree = ''.join(f'{type_} {oid} {name}\n' for name, oid, type_ in sorted(entries))
+    node['oid'] = data.hash_object(tree.encode(), 'tree')
+    return node['oid']
+
+
+class _Importer:
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.marks = {}
+        # ref -> last commit oid, written to the repository at the end
+        self.refs = {}
+        # commit oid -> the root directory of its tree, to continue from
+        self.roots = {}
+        self.blobs = 0
+        self.commits = 0
+
+    def _readline(self):
+        line = self.stream.readline()
+        if not line:
+            return None
+        return line.rstrip(b'\n').decode()
+
+    def _next_line(self):
+        """
+        like _readline(), inside a command that isn't complete yet
+        """
+        line = self._readline()
+        if line is None:
+            assert False, 'Unexpected end of stream'
+        return line
+
+    def _read_data(self, line):
+        assert line.startswith('data '), f'Expected data, got {line}'
+        size = int(line[5:])
+        content = self.stream.read(size)
+        assert len(content) == size, f'Expected {size} bytes of data, got {len(content)}'
+        return content
+
+    def _resolve(self, name):
+        if name.startswith(':'):
+            return self.marks[name]
+        return name
+
+    def _last_commit(self, ref):
+        if ref in self.refs:
+            return self.refs[ref]
+        return data.get_ref(ref).value
+
+    def _root_of(self, commit_oid):
+        if commit_oid in self.roots:
+            return self.roots.pop(commit_oid)
+        if not commit_oid:
+            return _new_dir()
+        return _new_dir(base.get_commit(commit_oid).tree)
+
+    def run(self):
+        line = self._readline()
+        while line is not None:
+            if not line:
+                line = self._readline()
+            elif line == 'done':
+                break
+            elif line == 'blob':
+                line = self._blob()
+            elif line.startswith('commit '):
+                line = self._commit(line[7:])
+            elif line.startswith('reset '):
+                line = self._reset(line[6:])
+            else:
+                assert False, f'Unknown command {line}'
+
+    def update_refs(self):
+        with data.ref_transaction() as transaction:
+            for ref, oid in self.refs.items():
+                if oid:
+                    transaction.update(ref, data.RefValue(symbolic=False, value=oid))
+                else:
+                    transaction.delete(ref)
+
+    def _blob(self):
+        line = self._next_line()
+        mark = None
+        if line.startswith('mark '):
+            mark = line[5:]
+            line = self._next_line()
+        oid = data.hash_object(self._read_data(line))
+        if mark:
+            self.marks[mark] = oid
+        self.blobs += 1
+        return self._readline()
+
+    def _commit(self, ref):
+        line = self._next_line()
+        mark = timestamp = None
+        if line.startswith('mark '):
+            mark = line[5:]
+            line = self._next_line()
+        if line.startswith('time '):
+            timestamp = line[5:]
+            line = self._next_line()
+        message = self._read_data(line).decode()
+
+        line = self._readline()
+        if line == '':
+            # an optional LF after the data
+            line = self._readline()
+        parents = []
+        if line is not None and line.startswith('from '):
+            parents.append(self._resolve(line[5:]))
+            line = self._readline()
+        else:
+            last = self._last_commit(ref)
+            if last:
+                parents.append(last)
+        while line is not None and line.startswith('merge '):
+            parents.append(self._resolve(line[6:]))
+            line = self._readline()
+
+        # later commits of the ref continue from this tree
+        root = self._root_of(parents[0] if parents else None)
+        while line:
+            if line == 'deleteall':
+                root = _new_dir()
+            elif line.startswith('M '):
+                oid, path = line[2:].split(' ', 1)
+                _set_path(root, path, self._resolve(oid))
+            elif line.startswith('D '):
+                _delete_path(root, line[2:])
+            else:
+                break
+            line = self._readline()
+
+        commit = f'tree {_write_dir(root) or data.hash_object(b"", "tree")}\n'
+        if timestamp:
+            commit += f'time {timestamp}\n'
+        commit += ''.join(f'parent {parent}\n' for parent in parents)
+        commit += '\n'
+        commit += message if message.endswith('\n') else f'{message}\n'
+        oid = data.hash_object(commit.encode(), 'commit')
+
+        self.roots[oid] = root
+        self.refs[ref] = oid
+        if mark:
+            self.marks[mark] = oid
+        self.commits += 1
+        return line
+
+    def _reset(self, ref):
+        line = self._readline()
+        if line is not None and line.startswith('from '):
+            self.refs[ref] = self._resolve(line[5:])
+            return self._readline()
+        self.refs[ref] = None
+        return line
+
+
+def fast_import(stream):
+    """
+    import the commands of a binary stream (see the module docstring)
+
+    :return: (number of blobs, number of commits) imported
+    """
+    importer = _Importer(stream)
+    with data.batch_objects():
+        importer.run()
+    # only once all the objects are stored
+    importer.update_refs()
+    return importer.blobs, importer.commits
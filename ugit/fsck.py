@@ -0,0 +1,208 @@
+"""
+contain 'ugit fsck': verify the integrity and connectivity of the object store
+
+Every object is re-hashed and parsed, in a pool of processes (each one
+opens the store of the repository itself). Then the history is walked
+from the refs and the index to find:
+
+    corrupt   the content doesn't hash to the oid, or can't be parsed
+    missing   referenced by a reachable object (or a ref), but not stored
+    dangling  stored, but neither reachable nor referenced by any object
+
+With incremental=True, objects verified by an earlier run are skipped
+when the size, mtime and inode of their file are the same (a file changed
+in any way is checked again). They are listed in .ugit/fsck-verified.
+The objects of the sqlite store have no file of their own and are always
+checked.
+"""
+import json
+import re
+
+from collections import namedtuple
+
+from . import data
+
+BATCH_SIZE = 256
+_TYPES = ('blob', 'tree', 'commit', 'chunk', 'chunked')
+
+Report = namedtuple('Report', ['checked', 'skipped', 'corrupt', 'missing', 'dangling'])
+
+
+def _state_path():
+    return f'{data.GIT_DIR}/fsck-verified'
+
+def _oid_pattern(object_format):
+    return re.compile(f'[0-9a-f]{{{data.OBJECT_FORMATS[object_format]}}}$')
+
+def parse_references(type_, content, object_format='sha1'):
+    """
+    :return: the objects an object points to, as a list of (type, oid)
+    """
+    refs = []
+    if type_ == 'tree':
+        for line in content.decode().splitlines():
+            entry_type, oid, name = line.split(' ', 2)
+            assert entry_type in ('blob', 'tree'), f'bad entry type {entry_type}'
+            assert name and '/' not in name and name not in ('.', '..'), f'bad name {name!r}'
+            refs.append((entry_type, oid))
+    elif type_ == 'commit':
+        headers, _, _ = content.decode().partition('\n\n')
+        for line in headers.splitlines():
+            key, value = line.split(' ', 1)
+            if key == 'tree':
+                refs.append(('tree', value))
+            elif key == 'parent':
+                refs.append(('commit', value))
+        assert refs and refs[0][0] == 'tree', 'no tree'
+    elif type_ == 'chunked':
+        for line in content.decode().splitlines():
+            oid, size = line.split(' ')
+            int(size)
+            refs.append(('chunk', oid))
+    oid_pattern = _oid_pattern(object_format)
+    for _, oid in refs:
+        assert oid_pattern.match(oid), f'bad oid {oid!r}'
+    return refs
+
+def _verify(store, object_format, oid):
+    """
+    :return: (type, references, None) or (None, [], why it is corrupt)
+    """
+    with store.open_view(oid) as opened:
+        if opened is None:
+            return None, [], 'disappeared'
+        view, _ = opened
+        end = bytes(view[:16]).find(b'\x00')
+        type_ = bytes(view[:max(end, 0)]).decode(errors='replace')
+        if end < 0 or type_ not in _TYPES:
+            return None, [], 'no valid type header'
+        with view[end + 1:] as content:
+            hasher = data.new_hasher(object_format)
+            if type_ == 'chunked':
+                # the oid is the hash of the reassembled blob
+                content = bytes(content)
+                hasher.update(b'blob\x00')
+            else:
+                hasher.update(view[:end + 1])
+                hasher.update(content)
+                content = bytes(content) if type_ in ('tree', 'commit') else b''
+    try:
+        refs = parse_references(type_, content, object_format)
+    except (AssertionError, ValueError) as e:
+        return None, [], f'unparsable {type_}: {e}'
+    if type_ == 'chunked':
+        for _, chunk_oid in refs:
+            chunk = store.read(chunk_oid)
+            if chunk is None:
+                return None, [], f'missing chunk {chunk_oid}'
+            hasher.update(chunk.partition(b'\x00')[2])
+    if hasher.hexdigest() != oid:
+        return None, [], f'hash mismatch (content hashes to {hasher.hexdigest()})'
+    return type_, refs, None
+
+def _verify_batch(git_dir, object_format, oids):
+    """
+    run in the worker processes
+    """
+    from . import object_store
+    store = object_store.open_store(git_dir)
+    return [(oid, *_verify(store, object_format, oid)) for oid in oids]
+
+def _read_references(store, object_format, oid):
+    # objects skipped in incremental mode still need their references
+    obj = store.read(oid)
+    type_, _, content = obj.partition(b'\x00')
+    type_ = type_.decode()
+    return type_, parse_references(type_, content, object_format)
+
+def fsck(jobs=None, incremental=False):
+    """
+    :jobs: number of processes hashing objects (the number of CPUs by default)
+    :return: a Report; corrupt is a list of (oid, why), missing and dangling are lists
+             of (type, oid)
+    """
+    store = data.get_store()
+    object_format = data.get_object_format()
+    oid_pattern = _oid_pattern(object_format)
+    objects = dict(store.iter_objects())
+
+    verified = {}
+    if incremental:
+        try:
+            with open(_state_path()) as f:
+                verified = json.load(f)
+        except (OSError, ValueError):
+            # none yet, or unreadable: check everything
+            pass
+    # oid -> (type, references) of the objects that are fine
+    good = {}
+    corrupt = []
+    to_check = []
+    skipped = 0
+    for oid, stat in objects.items():
+        if not oid_pattern.match(oid):
+            corrupt.append((oid, 'not an oid'))
+        elif stat is not None and oid in verified and verified[oid][0] == list(stat):
+            skipped += 1
+            type_ = verified[oid][1]
+            good[oid] = (type_, [] if type_ in ('blob', 'chunk') else None)
+        else:
+            to_check.append(oid)
+
+    batches = [to_check[i:i + BATCH_SIZE] for i in range(0, len(to_check), BATCH_SIZE)]
+    if len(batches) > 1 and jobs != 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs) as pool:
+            results = list(pool.map(_verify_batch, [data.GIT_DIR] * len(batches),
+                                    [object_format] * len(batches), batches))
+    else:
+        results = [_verify_batch(data.GIT_DIR, object_format, batch) for batch in batches]
+    for batch in results:
+        for oid, type_, refs, problem in batch:
+            if problem:
+                corrupt.append((oid, problem))
+            else:
+                good[oid] = (type_, refs)
+    for oid, (type_, refs) in good.items():
+        if refs is None:
+            good[oid] = _read_references(store, object_format, oid)
+
+    # connectivity from the refs and the index
+    roots = [('commit', ref.value) for _, ref in data.iter_refs()]
+    with data.get_index(write=False) as index:
+        roots.extend(('blob', oid) for oid in index.values())
+    shallow = data.get_shallow()
+    # in a partial clone, blobs are missing on purpose
+    promisor = data.get_config('remote.promisor')
+    reachable = set()
+    missing = {}
+    stack = list(roots)
+    while stack:
+        type_, oid = stack.pop()
+        if oid in reachable or oid in missing:
+            continue
+        if oid not in good:
+            # objects of alternates are checked by the fsck of their repository
+            if oid not in objects and not (promisor and type_ == 'blob') \
+                    and not data.object_exists(oid):
+                missing[oid] = type_
+            continue
+        reachable.add(oid)
+        for ref_type, ref in good[oid][1]:
+            if ref_type == 'commit' and oid in shallow:
+                # the parents of shallow commits weren't fetched
+                continue
+            stack.append((ref_type, ref))
+
+    referenced = {ref for _, refs in good.values() for _, ref in refs}
+    dangling = [(good[oid][0], oid) for oid in sorted(good)
+                if oid not in reachable and oid not in referenced]
+
+    with data._locked(_state_path()) as lock:
+        lock.commit(json.dumps({oid: [objects[oid], type_] for oid, (type_, _) in good.items()
+                                if objects.get(oid) is not None}))
+
+    return Report(checked=len(to_check), skipped=skipped,
+                  corrupt=sorted(corrupt),
+                  missing=sorted((type_, oid) for oid, type_ in missing.items()),
+                  dangling=dangling)
@@ -0,0 +1,343 @@
+"""
+contain the optional filesystem monitor that records which paths changed
+
+'ugit fsmonitor' watches the working directory with Linux inotify (through
+ctypes) and appends every touched path to .ugit/fsmonitor/journal.
+get_working_tree() uses it to rehash only the paths touched since the
+last query instead of walking and hashing the whole directory.
+
+The journal starts with a random token. The snapshot of the last query
+remembers the token and how far into the journal it has read; whenever
+the two don't line up (watcher restarted, journal rotated after growing
+too big or after an inotify queue overflow) a full scan is done instead.
+"""
+import json
+import os
+import signal
+import struct
+import sys
+import time
+import uuid
+
+from . import data
+from . import ignore
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF)
+
+_EVENT = struct.Struct('iIII')
+
+# the journal is started over (forcing one full scan) when it gets bigger
+JOURNAL_MAX_SIZE = 16 * 1024 * 1024
+# how long a query waits for the watcher to catch up with the filesystem
+COOKIE_TIMEOUT = 1.0
+
+
+def _dir():
+    return f'{data.GIT_DIR}/fsmonitor'
+
+def _journal_path():
+    return f'{_dir()}/journal'
+
+def _pid_path():
+    return f'{_dir()}/pid'
+
+def _snapshot_path():
+    return f'{_dir()}/snapshot'
+
+def is_running():
+    """
+    if a watcher is running for the current repository
+    """
+    try:
+        with open(_pid_path()) as f:
+            pid = int(f.read())
+        os.kill(pid, 0)
+    except (FileNotFoundError, ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def stop():
+    """
+    stop the watcher of the current repository
+
+    :return: whether a watcher was running
+    """
+    if not is_running():
+        return False
+    with open(_pid_path()) as f:
+        os.kill(int(f.read()), signal.SIGTERM)
+    return True
+
+def _load_libc():
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    assert hasattr(libc, 'inotify_init1'), 'inotify is only available on Linux'
+    libc.errno = ctypes.get_errno
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+def _start_journal():
+    """
+    start a new journal with a new token, making every snapshot outdated
+    """
+    tmp = f'{_journal_path()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(uuid.uuid4().hex.encode() + b'\x00')
+    os.replace(tmp, _journal_path())
+
+
+class _Watcher:
+
+    def __init__(self, libc):
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(libc.errno(), 'inotify_init1 failed')
+        # watch descriptor -> directory path relative to the working directory
+        self.dirs = {}
+        # paths of this batch of events
+        self.changed = []
+        self.own_dir = os.path.relpath(_dir())
+
+    def watch_tree(self, top):
+        """
+        watch 'top' and all of its subdirectories, except ignored ones
+        """
+        for root, _, _ in ignore.walk(top):
+            self._add_watch(os.path.relpath(root))
+
+    def _add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, path.encode(), WATCH_MASK)
+        if wd >= 0:
+            self.dirs[wd] = path
+
+    def _created_dir(self, path):
+        """
+        a directory appeared: watch it, and everything already inside is changed
+        """
+        self.watch_tree(path)
+        for root, _, filenames in ignore.walk(path):
+            self.changed.extend(os.path.relpath(f'{root}/{name}') for name in filenames)
+
+    def _removed_dir(self, path):
+        """
+        a directory went away: forget its watches, as a moved directory
+        keeps them but they'd still report the old path
+        """
+        self.changed.append(path)
+        prefix = f'{path}/'
+        for wd, dirpath in list(self.dirs.items()):
+            if dirpath == path or dirpath.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.dirs[wd]
+
+    def read_events(self):
+        """
+        block until there are events and translate them to changed paths
+
+        :return: False if the kernel queue overflowed and events were lost
+        """
+        buf = os.read(self.fd, 64 * 1024)
+        offset = 0
+        overflowed = False
+        while offset < len(buf):
+            wd, mask, _, length = _EVENT.unpack_from(buf, offset)
+            offset += _EVENT.size
+            name = buf[offset:offset + length].rstrip(b'\x00').decode()
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                overflowed = True
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            dirpath = self.dirs.get(wd)
+            if dirpath is None:
+                continue
+            if not name:
+                # event on the watched directory itself (deleted or moved away)
+                self.changed.append(dirpath)
+                continue
+            if dirpath == self.own_dir and not name.startswith('cookie-'):
+                # our own journal and snapshot writes
+                continue
+            path = name if dirpath == '.' else f'{dirpath}/{name}'
+            if path == ignore.IGNORE_FILE:
+                # directories may not be ignored anymore, watch them too
+                # (watching a directory again keeps its watch)
+                self.watch_tree('.')
+            if mask & IN_ISDIR:
+                # files of a new directory are listed by _created_dir(),
+                # other changes of a directory's own metadata don't matter
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._created_dir(path)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._removed_dir(path)
+                continue
+            self.changed.append(path)
+        return not overflowed
+
+    def flush(self):
+        if not self.changed:
+            return
+        entries = b''.join(path.encode() + b'\x00' for path in self.changed)
+        self.changed = []
+        with open(_journal_path(), 'ab') as f:
+            f.write(entries)
+
+
+def watch():
+    """
+    record changed paths of the working directory into the journal until killed
+    """
+    libc = _load_libc()
+    os.makedirs(_dir(), exist_ok=True)
+    assert not is_running(), 'A filesystem monitor is already running'
+
+    watcher = _Watcher(libc)
+    watcher.watch_tree('.')
+    # the cookie files of queries are created in the fsmonitor directory
+    watcher._add_watch(watcher.own_dir)
+    _start_journal()
+    with open(_pid_path(), 'w') as f:
+        f.write(str(os.getpid()))
+    # 'ugit fsmonitor --stop' sends SIGTERM, exit through the finally below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        while True:
+            if not watcher.read_events():
+                # events were lost, nothing in the journal can be trusted
+                watcher.changed = []
+                _start_journal()
+                continue
+            watcher.flush()
+            if os.path.getsize(_journal_path()) > JOURNAL_MAX_SIZE:
+                _start_journal()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.remove(_pid_path())
+        os.close(watcher.fd)
+
+def _read_journal(token, offset):
+    """
+    :return: (changed paths, new offset), or None if the journal
+             isn't the one the snapshot was taken from
+    """
+    try:
+        with open(_journal_path(), 'rb') as f:
+            journal = f.read()
+    except FileNotFoundError:
+        return None
+    header, _, _ = journal.partition(b'\x00')
+    if header.decode() != token or offset > len(journal):
+        return None
+    # the watcher may be in the middle of appending an entry
+    end = journal.rfind(b'\x00') + 1
+    paths = journal[offset:end].decode().split('\x00')[:-1]
+    return paths, end
+
+def _sync(token, offset):
+    """
+    make sure the watcher has seen every change made before this call,
+    by creating a cookie file and waiting for it to show up in the journal
+
+    :return: like _read_journal(), or None if the watcher didn't answer in time
+    """
+    cookie = os.path.relpath(f'{_dir()}/cookie-{os.getpid()}-{time.monotonic_ns()}')
+    open(cookie, 'w').close()
+    try:
+        deadline = time.monotonic() + COOKIE_TIMEOUT
+        while time.monotonic() < deadline:
+            result = _read_journal(token, offset)
+            if result is None or cookie in result[0]:
+                return result
+            time.sleep(0.002)
+        return None
+    finally:
+        os.remove(cookie)
+
+def _current_position():
+    with open(_journal_path(), 'rb') as f:
+        journal = f.read()
+    return journal.partition(b'\x00')[0].decode(), journal.rfind(b'\x00') + 1
+
+def get_working_tree():
+    """
+    :return: the working tree {path: oid} as base.get_working_tree(), updated from
+             the journal, or None if no watcher is running
+    """
+    from . import base
+    if not is_running():
+        return None
+
+    snapshot = None
+    try:
+        with open(_snapshot_path()) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        # none yet, or unreadable: scan the whole working directory
+        pass
+
+    changes = snapshot and _sync(snapshot['token'], snapshot['offset'])
+    if changes and ignore.IGNORE_FILE in changes[0]:
+        # any file may have become ignored or not
+        changes = None
+    if changes is None:
+        # remember the position before scanning, so that changes made
+        # during the scan are looked at again by the next query
+        token, offset = _current_position()
+        tree = base.scan_working_tree()
+    else:
+        paths, offset = changes
+        token, tree = snapshot['token'], snapshot['tree']
+        _update_tree(tree, set(paths))
+
+    # other queries may be reading it, replace it at once
+    tmp = f'{_snapshot_path()}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'token': token, 'offset': offset, 'tree': tree}, f)
+    os.replace(tmp, _snapshot_path())
+    return tree
+
+def _update_tree(tree, paths):
+    """
+    bring the entries of 'paths' in tree {path: oid} up to date with the disk
+    """
+    from . import base
+    sparse_dirs = data.get_sparse_dirs()
+    for path in paths:
+        if base.is_ignored(path) or not base.is_sparse_included(path, sparse_dirs):
+            continue
+        if os.path.isfile(path):
+            tree[path] = base._hash_file(path)
+        elif os.path.isdir(path):
+            tree.pop(path, None)
+            tree.update(base.scan_working_tree(path))
+        else:
+            tree.pop(path, None)
+            # a whole directory may have been moved away or deleted
+            prefix = f'{path}/'
+            for gone in [p for p in tree if p.startswith(prefix)]:
+                del tree[gone]
@@ -0,0 +1,124 @@
+"""
+contain the commit graph export of 'ugit k', as DOT (for graphviz) or JSON
+
+The output is produced as a stream of chunks while the history is walked,
+so nothing is held in memory but the walk itself. Simplifying linear chains
+needs to know the children of every commit, so then the (bounded, see
+max_count) set of commits is collected first.
+"""
+import fnmatch
+import itertools
+import json
+
+from . import base
+from . import data
+
+
+def iter_refs(patterns=None):
+    """
+    :patterns: only the refs matching one of these globs (all refs if empty)
+    :return: a generator of (refname, RefValue without dereferencing)
+    """
+    for refname, ref in data.iter_refs(deref=False):
+        if not patterns or any(fnmatch.fnmatchcase(refname, pattern) for pattern in patterns):
+            yield refname, ref
+
+def iter_commits(oids, max_count=None, first_parent=False):
+    """
+    :return: a generator of (oid, parents) of the commits reachable from oids,
+             at most max_count of them; with first_parent, only the first parents
+    """
+    shallow = data.get_shallow()
+    commits = base.iter_commits_and_parents(oids, first_parent=first_parent)
+    for oid in itertools.islice(commits, max_count):
+        parents = base.get_commit(oid).parents
+        if first_parent:
+            parents = parents[:1]
+        if oid in shallow:
+            # their parents weren't fetched
+            parents = []
+        yield oid, parents
+
+def simplify_chains(commits, keep):
+    """
+    collapse linear chains: a commit that is the only parent of its only child,
+    and isn't in 'keep' (e.g. the commits with refs), is merged into its child
+
+    :commits: (oid, parents) pairs
+    :return: a list of (top oid, parents of the bottom commit, oids in the chain)
+    """
+    commits = dict(commits)
+    children = {}
+    for oid, parents in commits.items():
+        for parent in parents:
+            children.setdefault(parent, []).append(oid)
+
+    def merged_into_child(oid):
+        if oid not in commits or oid in keep or len(children.get(oid, [])) != 1:
+            return False
+        return len(commits[children[oid][0]]) == 1
+
+    result = []
+    for oid, parents in commits.items():
+        if merged_into_child(oid):
+            continue
+        chain = [oid]
+        while len(parents) == 1 and merged_into_child(parents[0]):
+            chain.append(parents[0])
+            parents = commits[parents[0]]
+        result.append((oid, parents, chain))
+    return result
+
+def iter_dot(refs, nodes):
+    """
+    :refs: (refname, RefValue) pairs
+    :nodes: (oid, parents, chain) triples, chain is the list of oids of the node
+    :return: a generator of the chunks of a DOT graph
+    """
+    yield 'digraph commits {\n'
+    for refname, ref in refs:
+        yield f'"{refname}" [shape=note]\n'
+        yield f'"{refname}" -> "{ref.value}"\n'
+    for oid, parents, chain in nodes:
+        label = oid[:10]
+        if len(chain) > 1:
+            label = f'{oid[:10]}..{chain[-1][:10]}\\n{len(chain)} commits'
+        yield f'"{oid}" [shape=box style=filled label="{label}"]\n'
+        for parent in parents:
+            yield f'"{oid}" -> "{parent}"\n'
+    yield '}\n'
+
+def iter_json(refs, nodes):
+    """
+    like iter_dot(), as one JSON object:
+    {"refs": {refname: value}, "commits": [{"oid", "parents", "message"[, "last", "count"]}]}
+    """
+    yield '{"refs": {'
+    yield ', '.join(f'{json.dumps(refname)}: {json.dumps(ref.value)}' for refname, ref in refs)
+    yield '},\n"commits": ['
+    separator = '\n'
+    for oid, parents, chain in nodes:
+        node = {'oid': oid, 'parents': parents,
+                'message': base.get_commit(oid).message.split('\n', 1)[0]}
+        if len(chain) > 1:
+            node['last'] = chain[-1]
+            node['count'] = len(chain)
+        yield separator + json.dumps(node)
+        separator = ',\n'
+    yield '\n]}\n'
+
+def export(format_='dot', patterns=None, max_count=None, first_parent=False, simplify=False):
+    """
+    :return: a generator of the chunks of the graph of the refs matching 'patterns'
+             and the commits reachable from them
+    """
+    refs = list(iter_refs(patterns))
+    oids = [data.get_ref(refname).value for refname, _ in refs]
+    commits = iter_commits(oids, max_count, first_parent)
+    if simplify:
+        nodes = simplify_chains(commits, keep=set(oids))
+    else:
+        nodes = ((oid, parents, [oid]) for oid, parents in commits)
+    if format_ == 'json':
+        return iter_json(refs, nodes)
+    return iter_dot(refs, nodes)
@@ -0,0 +1,141 @@
+"""
+contain 'ugit grep': search the files of commits (or of the working directory)
+
+The trees of all the commits are read first. A blob is often the same in
+many commits (e.g. release tags), so every distinct blob is scanned only
+once, by a pool of processes, and its matches are shown for every path and
+commit it appears at. The output streams in the order of the commits and
+paths: the blobs are scanned in the order they first appear, and a path is
+printed as soon as its blob is done.
+
+Each blob is searched as a whole (not line by line) and only the lines of
+the matches are cut out. With names_only, the scan of a blob stops at its
+first match.
+"""
+import os
+import re
+
+from . import base
+from . import data
+
+# distinct blobs given to a worker at once
+BATCH_SIZE = 64
+# like git, a blob with a NUL byte in its beginning is binary
+BINARY_CHECK_SIZE = 8000
+
+
+def compile_pattern(pattern, ignore_case=False):
+    flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+    return re.compile(pattern.encode(), flags)
+
+def scan(regex, content, names_only=False):
+    """
+    :return: the matching lines of content, as a list of (line number, line),
+             [(None, None)] if content is binary and matches, [] if nothing matches
+    """
+    if b'\x00' in content[:BINARY_CHECK_SIZE]:
+        return [(None, None)] if regex.search(content) else []
+    lines = []
+    number = 1
+    # the line numbers are counted from the end of the last match
+    counted = 0
+    pos = 0
+    while True:
+        match = regex.search(content, pos)
+        if not match:
+            return lines
+        start = content.rfind(b'\n', 0, match.start()) + 1
+        end = content.find(b'\n', match.start())
+        if end < 0:
+            end = len(content)
+        number += content.count(b'\n', counted, start)
+        counted = start
+        lines.append((number, content[start:end]))
+        if names_only:
+            return lines
+        # the next match is on another line
+        pos = end + 1
+        if pos >= len(content):
+            return lines
+
+def _scan_batch(repo_path, pattern, ignore_case, names_only, oids):
+    """
+    run in the worker processes
+
+    :return: {oid: matching lines} of the blobs with matches
+    """
+    regex = compile_pattern(pattern, ignore_case)
+    result = {}
+    with data.change_git_dir(repo_path):
+        for oid in oids:
+            lines = scan(regex, data.get_object(oid), names_only)
+            if lines:
+                result[oid] = lines
+    return result
+
+def _iter_trees(commits):
+    """
+    :commits: names of commits, the working directory if empty
+    :return: a list of (prefix of the output, {path: oid})
+    """
+    if not commits:
+        return [('', base.get_working_tree())]
+    return [(f'{name}:', base.get_tree(base.get_commit(base.get_oid(name)).tree))
+            for name in commits]
+
+def grep(pattern, commits=(), ignore_case=False, names_only=False, line_numbers=False,
+         jobs=None):
+    """
+    :commits: names of the commits to search, the working directory if empty
+    :names_only: only the names of the files with matches ('commit:path')
+    :jobs: number of processes scanning blobs (the number of CPUs by default)
+    :return: a generator of output lines as bytes, 'commit:path:line'
+             ('commit:path:number:line' with line_numbers)
+    """
+    # check the pattern before starting any process
+    compile_pattern(pattern, ignore_case)
+    trees = _iter_trees(commits)
+
+    # the distinct blobs, in the order they first appear in the output
+    oids = list(dict.fromkeys(oid for _, tree in trees for _, oid in sorted(tree.items())))
+    batches = [oids[i:i + BATCH_SIZE] for i in range(0, len(oids), BATCH_SIZE)]
+    batch_of = {oid: i for i, batch in enumerate(batches) for oid in batch}
+    repo_path = os.path.dirname(os.path.abspath(data.GIT_DIR))
+    args = (repo_path, pattern, ignore_case, names_only)
+
+    pool = None
+    if len(batches) > 1 and jobs != 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(jobs)
+        futures = [pool.submit(_scan_batch, *args, batch) for batch in batches]
+        get_batch = lambda i: futures[i].result()
+    else:
+        get_batch = lambda i: _scan_batch(*args, batches[i])
+
+    # results of the scanned batches, by batch
+    done = {}
+    try:
+        for prefix, tree in trees:
+            for path, oid in sorted(tree.items()):
+                i = batch_of[oid]
+                if i not in done:
+                    done[i] = get_batch(i)
+                lines = done[i].get(oid)
+                if not lines:
+                    continue
+                name = f'{prefix}{path}'.encode()
+                if names_only:
+                    yield name + b'\n'
+                elif lines[0][0] is None:
+                    yield b'Binary file ' + name + b' matches\n'
+                else:
+                    for number, line in lines:
+                        if line_numbers:
+                            yield b'%s:%d:%s\n' % (name, number, line)
+                        else:
+                            yield b'%s:%s\n' % (name, line)
+    finally:
+        if pool:
+            # the output may have been cut short (e.g. by 'head'), don't
+            # scan the batches that weren't started yet
+            pool.shutdown(cancel_futures=True)
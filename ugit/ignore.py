@@ -0,0 +1,175 @@
+"""
+contain the .ugitignore matcher: which files of the working directory aren't the user's
+
+.ugitignore (at the top of the working directory) has one pattern per line,
+like .gitignore:
+
+    # comment         blank lines and lines starting with '#' are skipped
+    *.pyc             globs ('*', '?', '[...]') match a name at any depth
+    build/            a trailing '/' only matches directories
+    /TODO, doc/*.txt  a '/' at the start or in the middle anchors the pattern
+                      to the top of the working directory
+    **/cache, a/**    '**' matches any number of directories
+    !keep.pyc         '!' re-includes what an earlier pattern ignored
+
+The last matching pattern wins. Everything inside an ignored directory is
+ignored, and walk() doesn't even descend into it. .ugit is always ignored.
+
+The patterns are compiled into a few regexes: consecutive patterns of the
+same kind (ignoring or re-including) are joined into one alternation, so a
+path is matched against each group at most once, the last groups first.
+"""
+import os
+import re
+
+from . import data
+
+IGNORE_FILE = '.ugitignore'
+
+# matchers by the stat of .ugitignore, when caches are off
+_matcher_cache = {}
+
+
+def _translate(glob):
+    """
+    :return: the regex of a glob, '*' and '?' don't match '/'
+    """
+    result = []
+    i = 0
+    while i < len(glob):
+        c = glob[i]
+        if glob.startswith('**/', i):
+            result.append('(?:.*/)?')
+            i += 3
+            continue
+        if glob.startswith('**', i):
+            result.append('.*')
+            i += 2
+            continue
+        if c == '*':
+            result.append('[^/]*')
+        elif c == '?':
+            result.append('[^/]')
+        elif c == '[' and ']' in glob[i + 2:]:
+            end = glob.index(']', i + 2)
+            chars = glob[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            result.append(f'[{chars.replace(chr(92), chr(92) * 2)}]')
+            i = end
+        elif c == '\\' and i + 1 < len(glob):
+            i += 1
+            result.append(re.escape(glob[i]))
+        else:
+            result.append(re.escape(c))
+        i += 1
+    return ''.join(result)
+
+def parse_pattern(line):
+    """
+    :return: (regex matching a whole path, negate, dir_only), or None for
+             blank lines and comments
+    """
+    line = line.rstrip('\n')
+    if not line.endswith('\\ '):
+        line = line.rstrip()
+    if not line or line.startswith('#'):
+        return None
+    negate = line.startswith('!')
+    if negate:
+        line = line[1:]
+    elif line.startswith('\\'):
+        # '\#' and '\!' are literal
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+        return None
+    anchored = '/' in line
+    regex = _translate(line.lstrip('/'))
+    if not anchored:
+        # a name, at any depth
+        regex = f'(?:.*/)?{regex}'
+    return regex, negate, dir_only
+
+
+class Matcher:
+
+    def __init__(self, lines):
+        # [(negate, regex for any path, regex for directories only)],
+        # consecutive patterns of the same kind joined together
+        self.groups = []
+        patterns = [p for p in map(parse_pattern, lines) if p]
+        start = 0
+        for end in range(1, len(patterns) + 1):
+            if end < len(patterns) and patterns[end][1] == patterns[start][1]:
+                continue
+            group = patterns[start:end]
+            any_ = [regex for regex, _, dir_only in group if not dir_only]
+            # directories match the patterns of both kinds
+            dirs = [regex for regex, _, _ in group]
+            self.groups.append((group[0][1], _compile(any_), _compile(dirs)))
+            start = end
+        # directory path -> ignored, the parents of many paths are the same
+        self.dirs = {}
+
+    def match(self, path, is_dir=False):
+        """
+        :return: whether 'path' itself is ignored, not looking at its parents
+        """
+        if path == '.ugit' or path.endswith('/.ugit'):
+            return True
+        for negate, any_, dirs in reversed(self.groups):
+            regex = dirs if is_dir else any_
+            if regex and regex.fullmatch(path):
+                return not negate
+        return False
+
+    def is_ignored(self, path, is_dir=False):
+        """
+        :return: whether 'path' or one of its parent directories is ignored
+        """
+        parent = os.path.dirname(path)
+        if parent and self._is_dir_ignored(parent):
+            return True
+        return self.match(path, is_dir)
+
+    def _is_dir_ignored(self, path):
+        if path not in self.dirs:
+            parent = os.path.dirname(path)
+            self.dirs[path] = bool(parent and self._is_dir_ignored(parent)) \
+                or self.match(path, is_dir=True)
+        return self.dirs[path]
+
+
+def _compile(regexes):
+    return regexes and re.compile('|'.join(f'(?:{regex})' for regex in regexes))
+
+def get_matcher():
+    """
+    :return: the Matcher of the .ugitignore of the working directory
+    """
+    def load():
+        if not os.path.isfile(IGNORE_FILE):
+            return Matcher([])
+        with open(IGNORE_FILE) as f:
+            return Matcher(f.readlines())
+
+    cache = data.get_cache('ignore')
+    return data.cached_by_stat(_matcher_cache if cache is None else cache,
+                               IGNORE_FILE, load)
+
+def walk(top='.'):
+    """
+    like os.walk(), but ignored directories aren't descended into and ignored
+    files aren't listed. Nothing is yielded if 'top' itself is ignored
+    """
+    matcher = get_matcher()
+    if os.path.relpath(top) != '.' and matcher.is_ignored(os.path.relpath(top), is_dir=True):
+        return
+    for root, dirnames, filenames in os.walk(top):
+        root_path = os.path.relpath(root)
+        prefix = '' if root_path == '.' else f'{root_path}/'
+        dirnames[:] = [d for d in dirnames if not matcher.match(prefix + d, is_dir=True)]
+        filenames[:] = [f for f in filenames if not matcher.match(prefix + f)]
+        yield root, dirnames, filenames
@@ -0,0 +1,247 @@
+"""
+contain the object stores: where the objects of a repository are kept
+
+An object is stored as 'type\x00content' under its oid (a chunked blob as
+its manifest, see data.hash_object()). Two stores implement the same methods:
+
+    LooseStore   one file per object in .ugit/objects/ (the default)
+    SqliteStore  one table in .ugit/objects.db, much faster than millions
+                 of small files, especially on network filesystems
+
+The store of a repository is chosen at 'ugit init --object-store' and
+recorded as core.objectStore in its config. A new store can be filled
+with the objects of another store of the same kind, cheaply (see
+populate_from(), used by 'ugit clone'). A store is opened for an
+explicit .ugit directory (never through data.GIT_DIR), so fetch and push
+can use the local and the remote store at the same time, and it can be
+shared between threads.
+"""
+import os
+import threading
+
+from contextlib import contextmanager
+
+STORES = ('loose', 'sqlite')
+# ioctl asking Linux for a copy-on-write clone of a file (a reflink)
+FICLONE = 0x40049409
+
+# opened stores by absolute .ugit path
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class LooseStore:
+
+    def __init__(self, git_dir):
+        self.path = f'{git_dir}/objects'
+
+    def create(self):
+        os.makedirs(self.path, exist_ok=True)
+
+    def exists(self, oid):
+        return os.path.isfile(f'{self.path}/{oid}')
+
+    def read(self, oid):
+        """
+        :return: the stored object ('type\\x00content'), or None if it's missing
+        """
+        try:
+            with open(f'{self.path}/{oid}', 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @contextmanager
+    def open_view(self, oid):
+        """
+        yield (memoryview of the stored object, file descriptor of the object),
+        or None if it's missing. The view is an mmap of the file: pages are
+        only read when used, and nothing is copied into memory
+        """
+        try:
+            f = open(f'{self.path}/{oid}', 'rb')
+        except FileNotFoundError:
+            yield None
+            return
+        with f:
+            if not os.fstat(f.fileno()).st_size:
+                # an empty file can't be mapped
+                yield memoryview(b''), f.fileno()
+                return
+            import mmap
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                # the mmap can only be closed once no view of it is left
+                with memoryview(mapped) as view:
+                    yield view, f.fileno()
+
+    def write(self, oid, *parts):
+        """
+        store an object given as pieces of bytes (header and content)
+        """
+        # readers never see a half-written object
+        tmp = f'{self.path}/{oid}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as out:
+            for part in parts:
+                out.write(part)
+        os.replace(tmp, f'{self.path}/{oid}')
+
+    def iter_objects(self):
+        """
+        :return: a generator of (oid, (size, mtime_ns, inode) of its file) of
+                 every object
+        """
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.tmp'):
+                    st = entry.stat()
+                    yield entry.name, (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    @contextmanager
+    def batch(self):
+        # every file is its own transaction already
+        yield
+
+    def populate_from(self, source):
+        """
+        give this new store every object of the loose store 'source'
+
+        objects are never modified (a new version replaces the file), so the
+        files can be shared: hardlinked, or reflinked where hardlinks aren't
+        allowed, and copied only when neither works (e.g. another filesystem)
+
+        :return: {'hardlink' | 'reflink' | 'copy': number of objects}
+        """
+        methods = [_hardlink, _reflink, _copy]
+        counts = {}
+        for oid, _ in source.iter_objects():
+            src, dst = f'{source.path}/{oid}', f'{self.path}/{oid}'
+            # a method that failed once will fail for the next objects too
+            while True:
+                try:
+                    methods[0](src, dst)
+                    break
+                except OSError:
+                    if os.path.exists(dst):
+                        os.remove(dst)
+                    if len(methods) == 1:
+                        raise
+                    methods.pop(0)
+            name = methods[0].__name__[1:]
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+
+
+def _hardlink(src, dst):
+    os.link(src, dst)
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+def _copy(src, dst):
+    import shutil
+    shutil.copyfile(src, dst)
+
+
+class SqliteStore:
+
+    def __init__(self, git_dir):
+        self.path = f'{git_dir}/objects.db'
+        self.local = threading.local()
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads, nor
+        # survive a fork: one per thread and process
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            import sqlite3
+            self.local.connection = sqlite3.connect(self.path, timeout=30,
+                                                    isolation_level=None)
+            self.local.connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.pid = pid
+            self.local.batches = 0
+        return self.local.connection
+
+    def create(self):
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS objects (oid TEXT PRIMARY KEY, data BLOB NOT NULL)')
+
+    def exists(self, oid):
+        return self._connection().execute(
+            'SELECT 1 FROM objects WHERE oid = ?', (oid,)).fetchone() is not None
+
+    def read(self, oid):
+        row = self._connection().execute(
+            'SELECT data FROM objects WHERE oid = ?', (oid,)).fetchone()
+        return row and row[0]
+
+    @contextmanager
+    def open_view(self, oid):
+        # a row is read whole, there is no file to map or send
+        obj = self.read(oid)
+        yield obj and (memoryview(obj), None)
+
+    def write(self, oid, *parts):
+        self._connection().execute(
+            'INSERT OR IGNORE INTO objects VALUES (?, ?)', (oid, b''.join(parts)))
+
+    def iter_objects(self):
+        # fetched at once: the caller may write objects while iterating.
+        # A row has no stat: None, a change to it can't be told from here
+        return iter(self._connection().execute(
+            'SELECT oid, NULL FROM objects').fetchall())
+
+    @contextmanager
+    def batch(self):
+        """
+        make the writes of the block one transaction: much faster than one
+        transaction per object, and none of them is kept if the block fails
+        """
+        connection = self._connection()
+        if self.local.batches:
+            # nested in a batch already, it commits at its end
+            yield
+            return
+        connection.execute('BEGIN IMMEDIATE')
+        self.local.batches += 1
+        try:
+            yield
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        else:
+            connection.execute('COMMIT')
+        finally:
+            self.local.batches -= 1
+
+    def populate_from(self, source):
+        """
+        give this new store every object of the SQLite store 'source'
+
+        the database is one file that keeps changing, it can't be shared:
+        it's copied with SQLite's backup, consistent even during writes
+        """
+        source._connection().backup(self._connection())
+        return {'copy': self._connection().execute('SELECT count(*) FROM objects').fetchone()[0]}
+
+
+def _configured_store(git_dir):
+    if not os.path.isfile(f'{git_dir}/config'):
+        return 'loose'
+    import json
+    with open(f'{git_dir}/config') as f:
+        return json.load(f).get('core.objectStore', 'loose')
+
+def open_store(git_dir, kind=None):
+    """
+    :kind: 'loose' or 'sqlite', by default the one in the config of git_dir
+    :return: the object store of the repository in git_dir (its .ugit directory)
+    """
+    key = os.path.abspath(git_dir)
+    with _stores_lock:
+        if key not in _stores or kind:
+            kind = kind or _configured_store(git_dir)
+            assert kind in STORES, f'Unknown object store {kind}'
+            _stores[key] = SqliteStore(git_dir) if kind == 'sqlite' else LooseStore(git_dir)
+        return _stores[key]
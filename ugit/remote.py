@@ -3,31 +3,199 @@ contain all remote synchronization code
 """
 
 import os
+import threading
 
 from . import base
 from . import data
 
 REMOTE_REFS_BASE = 'refs/heads/'
 LOCAL_REFS_BASE = 'refs/remote/'
+# remotes fetched at the same time by fetch_remotes()
+DEFAULT_FETCH_JOBS = 4
 
 
-def fetch (remote_path):
+def get_remote_path(remote):
+    """
+    :remote: the name of a remote (remote.<name>.url in the config) or a path
+    :return: the path of the remote repository
+    """
+    return data.get_config(f'remote.{remote}.url', remote)
+
+def get_remote_names():
+    """
+    :return: the names of the remotes in the config
+    """
+    return [key[len('remote.'):-len('.url')]
+            for key, _ in data.iter_config('remote.') if key.endswith('.url')]
+
+def _local_refs_bases(remotes):
+    """
+    a named remote has its own namespace. A remote given by its path doesn't
+    when it is fetched alone; fetched with others, it is named after its
+    directory (with a suffix if that name is taken)
+
+    :return: {remote: the base of its refs here}
+    """
+    named = set(get_remote_names())
+    paths = [remote for remote in remotes if remote not in named]
+    if len(remotes) == 1 and paths:
+        return {remotes[0]: LOCAL_REFS_BASE}
+    bases = {remote: f'{LOCAL_REFS_BASE}{remote}/' for remote in remotes if remote in named}
+    taken = set(named)
+    for remote in paths:
+        dirname = os.path.basename(os.path.abspath(remote)) or 'remote'
+        name, suffix = dirname, 2
+        while name in taken:
+            name, suffix = f'{dirname}-{suffix}', suffix + 1
+        taken.add(name)
+        bases[remote] = f'{LOCAL_REFS_BASE}{name}/'
+    return bases
+
+def fetch (remote, blobs=True, depth=None):
     """
     change GIT_DIR to point to the remote repository 
     and save all refs locally using our battle-tested iter_refs function
+    
+    :remote: a remote name or path, see get_remote_path()
+    :blobs: if False, make a partial clone: only fetch commits and trees, 
+            and record the remote as the promisor that missing blobs are 
+            fetched from when they are needed
+    :depth: only fetch this many commits of each ref's history; the oldest
+            fetched commits are recorded as shallow and treated as roots
+    """
+    fetch_remotes([remote], blobs, depth)
+
+def fetch_remotes(remotes, blobs=True, depth=None, jobs=None):
+    """
+    fetch several remotes at once, like fetch()
+    
+    The objects of each remote are copied by its own thread (at most 'jobs',
+    fetch.parallel in the config, at the same time). An object that several
+    remotes have is copied once, from the first remote that gets to it.
+    The refs of the remotes that could be fetched are updated even if
+    another one failed, then the first error is raised. See
+    _local_refs_bases() for where the refs of each remote go.
     """
-    # Get refs from remote
-    refs = _get_remote_refs(remote_path, REMOTE_REFS_BASE)
+    remotes = list(dict.fromkeys(remotes))
+    assert blobs or len(remotes) == 1, 'A partial clone has only one promisor remote'
+    local_bases = _local_refs_bases(remotes)
+    
+    # Get refs from the remotes first: reading another repository switches
+    # data.GIT_DIR, which the fetching threads rely on
+    refs = {}
+    for remote in remotes:
+        _check_object_format(get_remote_path(remote))
+        refs[remote] = _get_remote_refs(get_remote_path(remote), REMOTE_REFS_BASE)
+
+    if not blobs:
+        data.set_config('remote.promisor', os.path.abspath(get_remote_path(remotes[0])))
 
     # Fetch missing objects by iterating and fetching on demand
-    for oid in base.iter_objects_in_commits(refs.values()):
-        data.fetch_object_if_missing(oid, remote_path)
+    shallow = data.get_shallow()
+    is_shallow = depth is not None or bool(shallow)
+    transfer = _Transfer()
+    
+    def fetch_objects(remote):
+        return _fetch_objects(get_remote_path(remote), refs[remote].values(),
+                              transfer, blobs, depth, is_shallow)
+    
+    results = {}
+    errors = []
+    if len(remotes) == 1:
+        with data.batch_objects():
+            results[remotes[0]] = fetch_objects(remotes[0])
+    else:
+        # no batch here: in one transaction per thread, the threads would wait
+        # for each other's, and not see the objects the others copied
+        from concurrent.futures import ThreadPoolExecutor
+        jobs = jobs or int(data.get_config('fetch.parallel', DEFAULT_FETCH_JOBS))
+        with ThreadPoolExecutor(jobs) as pool:
+            futures = {remote: pool.submit(fetch_objects, remote) for remote in remotes}
+        for remote, future in futures.items():
+            if future.exception():
+                errors.append(future.exception())
+            else:
+                results[remote] = future.result()
+    
+    if is_shallow and results:
+        walked = set().union(*(walked for walked, _ in results.values()))
+        boundary = set().union(*(boundary for _, boundary in results.values()))
+        data.set_shallow((shallow - walked) | boundary)
     
-    # Update local refs to match remote
-    for remote_name, value in refs.items():
-        refname = os.path.relpath(remote_name, REMOTE_REFS_BASE)
-        data.update_ref (f'{LOCAL_REFS_BASE}/{refname}',
-                        data.RefValue (symbolic=False, value=value))
+    # Update local refs to match remote in one transaction, so that
+    # concurrent fetches can't interleave their ref updates
+    with data.ref_transaction() as transaction:
+        for remote in results:
+            local_base = local_bases[remote]
+            for remote_name, value in refs[remote].items():
+                refname = os.path.relpath(remote_name, REMOTE_REFS_BASE)
+                transaction.update(f'{local_base}{refname}',
+                                   data.RefValue (symbolic=False, value=value))
+    if errors:
+        raise errors[0]
+
+def _fetch_objects(remote_path, oids, transfer, blobs, depth, is_shallow):
+    """
+    copy the objects of the commits 'oids' that are missing
+    
+    :return: (walked oids, boundary commits), for the shallow commits
+    """
+    boundary = set()
+    walked = set()
+    if not is_shallow:
+        objects = base.iter_objects_in_commits(oids, blobs=blobs)
+    else:
+        # the walk goes through the current shallow commits, so that fetching
+        # deeper (or without a depth) fills in the missing history
+        objects = base.iter_objects_in_commits(oids, blobs=blobs,
+                                               depth=depth, boundary=boundary)
+    for oid in objects:
+        transfer.fetch(oid, remote_path)
+        if is_shallow:
+            walked.add(oid)
+    return walked, boundary
+
+
+class _Transfer:
+    """
+    the objects being copied by concurrent fetches
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # oid -> Event set once the copy is over
+        self.copying = {}
+
+    def fetch(self, oid, remote_path):
+        """
+        copy an object from remote_path if it's missing, unless another
+        fetch is copying it: then wait for it, as the walk reads it next
+        """
+        while not data.object_exists(oid):
+            with self.lock:
+                event = self.copying.get(oid)
+                if event is None:
+                    event = self.copying[oid] = threading.Event()
+                    break
+            # if the other copy failed, the object is still missing: copy it from here
+            event.wait()
+        else:
+            return
+        try:
+            data.fetch_object_if_missing(oid, remote_path)
+        finally:
+            with self.lock:
+                del self.copying[oid]
+            event.set()
+
+def _check_object_format(remote_path):
+    """
+    objects are copied as they are, so both repositories must hash the same way
+    """
+    with data.change_git_dir(remote_path):
+        remote_format = data.get_object_format()
+    assert remote_format == data.get_object_format(), \
+        f'{remote_path} uses {remote_format} oids, this repository {data.get_object_format()}'
 
 def _get_remote_refs (remote_path, prefix=''):
     """
@@ -40,6 +208,7 @@ def push(remote_path, refname):
     """
     push
     """
+    _check_object_format(remote_path)
     # Get refs data from a branch_path
     remote_refs = _get_remote_refs(remote_path) # get refs from remote repository
     remote_ref = remote_refs.get(refname) #     
@@ -64,17 +233,79 @@ def push(remote_path, refname):
     # Compute which objects the server doesn't have
     # Since the remote might have refs that point to branches that we didn't pull yet, 
     #   filter out all refs that point to unknown OIDs
-    known_remote_refs = filter(data.object_exists, remote_refs)
+    known_remote_refs = filter(data.object_exists, remote_refs.values())
     remote_objects = set(base.iter_objects_in_commits(known_remote_refs))
     local_objects = set(base.iter_objects_in_commits({local_ref}))
     
     objects_to_push = local_objects - remote_objects
     
-    # Push all objects
-    for oid in objects_to_push:
-        data.push_object(oid, remote_path)
+    # Push all objects, in one transaction of the remote store
+    with data.get_remote_store(remote_path).batch():
+        for oid in objects_to_push:
+            data.push_object(oid, remote_path)
     
-    # Update server ref to our value
+    # Update server ref to our value, unless someone pushed since we looked at it
     with data.change_git_dir(remote_path):
         data.update_ref(refname,
-                        data.RefValue (symbolic=False, value=local_ref))
\ No newline at end of file
+                        data.RefValue (symbolic=False, value=local_ref),
+                        old=data.RefValue (symbolic=False, value=remote_ref))
+
+def clone(source, dest, shared=False):
+    """
+    make a new repository in 'dest' with the objects and branches of the
+    repository in 'source', and check out the branch of its HEAD
+    
+    the objects are shared with source instead of copied: hardlinked (or
+    reflinked or, across filesystems, copied; see object_store), or with
+    shared=True, not even linked but read from source (an alternate, see
+    data.get_alternates()). Then source must stay where it is.
+    
+    :return: {'hardlink' | 'reflink' | 'copy': number of objects}
+    """
+    source = os.path.abspath(source)
+    assert os.path.isdir(f'{source}/.ugit'), f'{source} is not a ugit repository'
+    assert not os.path.exists(dest) or not os.listdir(dest), \
+        f'{dest} already exists and is not empty'
+    with data.change_git_dir(source):
+        object_store = data.get_config('core.objectStore', 'loose')
+        object_format = data.get_object_format()
+        promisor = data.get_config('remote.promisor')
+        shallow = data.get_shallow()
+        alternates = data.get_alternates()
+        head = data.get_ref('HEAD', deref=False)
+    refs = _get_remote_refs(source, REMOTE_REFS_BASE)
+    
+    os.makedirs(dest, exist_ok=True)
+    cwd = os.getcwd()
+    # the working directory is checked out relative to the current directory
+    os.chdir(dest)
+    try:
+        base.init(object_store, object_format)
+        # the objects source reads from elsewhere are needed too
+        for git_dir in alternates:
+            data.add_alternate(git_dir)
+        if promisor:
+            data.set_config('remote.promisor', promisor)
+        data.set_shallow(shallow)
+        if shared:
+            data.add_alternate(f'{source}/.ugit')
+            counts = {}
+        else:
+            counts = data.get_store().populate_from(data.get_remote_store(source))
+        
+        data.set_config('remote.origin.url', source)
+        with data.ref_transaction() as transaction:
+            for remote_name, value in refs.items():
+                refname = os.path.relpath(remote_name, REMOTE_REFS_BASE)
+                transaction.update(f'{LOCAL_REFS_BASE}origin/{refname}',
+                                   data.RefValue (symbolic=False, value=value))
+                # the branches are local too, like after checking them out
+                transaction.update(remote_name, data.RefValue (symbolic=False, value=value))
+        
+        if head.symbolic and head.value in refs:
+            base.checkout(os.path.relpath(head.value, REMOTE_REFS_BASE))
+        elif not head.symbolic and head.value:
+            base.checkout(head.value)
+    finally:
+        os.chdir(cwd)
+    return counts
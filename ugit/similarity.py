@@ -0,0 +1,107 @@
+"""
+contain the content similarity sketches used to find renamed and copied files
+
+Every blob gets a small MinHash signature of its set of lines (one
+permutation hashing: each line hash falls into one of SIGNATURE_SIZE bins,
+a bin keeps its smallest value). The share of equal bins of two signatures
+estimates the Jaccard similarity of the two files' lines.
+
+To avoid comparing every new file with every old file, signatures are
+split into bands (locality-sensitive hashing): only files that have one
+whole band in common become candidates, which similar files almost always
+do and different files almost never do.
+"""
+import zlib
+
+from . import data
+
+SIGNATURE_SIZE = 64
+# rows per band: with 2, files of 50% similarity share a band 99.9% of the time
+BAND_ROWS = 2
+_MASK64 = (1 << 64) - 1
+# odd multiplier spreading the bits of crc32 over 64 bits (Fibonacci hashing)
+_MIX = 0x9E3779B97F4A7C15
+
+
+def signature(content):
+    """
+    :return: the MinHash signature of the lines of content, a tuple
+             of SIGNATURE_SIZE values (None for the bins no line fell in)
+    """
+    bins = [None] * SIGNATURE_SIZE
+    for line in set(content.splitlines()):
+        h = (zlib.crc32(line) * _MIX) & _MASK64
+        i, value = h % SIGNATURE_SIZE, h // SIGNATURE_SIZE
+        if bins[i] is None or value < bins[i]:
+            bins[i] = value
+    return tuple(bins)
+
+def get_signature(oid):
+    """
+    :return: the signature of the blob 'oid' and its size
+    """
+    cache = data.get_cache('signatures')
+    if cache is not None and oid in cache:
+        return cache[oid]
+    content = data.get_object(oid)
+    result = signature(content), len(content)
+    if cache is not None:
+        data.cache_add(cache, oid, result)
+    return result
+
+def estimate(sig_a, sig_b):
+    """
+    :return: the estimated similarity (0 to 1) of the files of two signatures
+    """
+    used = same = 0
+    for a, b in zip(sig_a, sig_b):
+        if a is None and b is None:
+            continue
+        used += 1
+        same += a == b
+    if not used:
+        # two empty files
+        return 1.0
+    return same / used
+
+def _bands(sig):
+    for start in range(0, SIGNATURE_SIZE, BAND_ROWS):
+        band = sig[start:start + BAND_ROWS]
+        if any(value is not None for value in band):
+            yield start, band
+
+def find_similar(sources, targets, threshold, max_candidates):
+    """
+    pair files of 'targets' with the most similar file of 'sources'
+
+    :sources: {path: oid} of the files that may have been renamed or copied
+    :targets: {path: oid} of the new files
+    :max_candidates: compare each target with at most this many sources
+    :return: a list of (score, target path, source path) with score >= threshold
+    """
+    signatures = {oid: get_signature(oid) for oid in {*sources.values(), *targets.values()}}
+
+    # band -> source paths with that band
+    buckets = {}
+    for path, oid in sources.items():
+        for band in _bands(signatures[oid][0]):
+            buckets.setdefault(band, []).append(path)
+
+    pairs = []
+    for path, oid in targets.items():
+        sig, size = signatures[oid]
+        candidates = {}
+        for band in _bands(sig):
+            for source in buckets.get(band, ()):
+                candidates[source] = candidates.get(source, 0) + 1
+        # the sources sharing the most bands first
+        best = sorted(candidates, key=lambda source: (-candidates[source], source))
+        for source in best[:max_candidates]:
+            source_sig, source_size = signatures[sources[source]]
+            # files of very different sizes can't be similar enough
+            if min(size, source_size) < threshold * max(size, source_size):
+                continue
+            score = estimate(sig, source_sig)
+            if score >= threshold:
+                pairs.append((score, path, source))
+    return pairs